@@ -0,0 +1,93 @@
+import base64
+import os
+import tracemalloc
+import uuid
+
+import pytest
+import webtest
+from kinto import main as kinto_main
+from kinto.core.testing import get_user_headers
+
+from kinto_elasticsearch.indexer import Indexer
+from .fake_elasticsearch import FakeElasticsearch
+
+
+#: Approximate size in bytes of the benchmarked records.
+RECORD_SIZES = [256, 16 * 1024, 512 * 1024]
+
+#: Number of records per bulk request or per event.
+BATCH_SIZES = [1, 100, 1000]
+
+#: Combinations of sizes above this volume (in bytes) are skipped.
+MAX_VOLUME = 64 * 1024 * 1024
+
+
+def make_records(size, count):
+    if size * count > MAX_VOLUME:
+        pytest.skip("Too much data")
+    return [make_record(size) for _ in range(count)]
+
+
+def make_record(size):
+    payload = base64.b64encode(os.urandom(size * 3 // 4)).decode("ascii")
+    return {"id": str(uuid.uuid4()), "title": "Benchmark", "payload": payload}
+
+
+@pytest.fixture(scope="session")
+def fake_es():
+    server = FakeElasticsearch().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def es(fake_es):
+    fake_es.reset()
+    return fake_es
+
+
+@pytest.fixture
+def indexer(es):
+    return Indexer(hosts=[es.host])
+
+
+@pytest.fixture
+def app(es):
+    settings = {
+        "includes": "kinto_elasticsearch",
+        "storage_backend": "kinto.core.storage.memory",
+        "cache_backend": "kinto.core.cache.memory",
+        "permission_backend": "kinto.core.permission.memory",
+        "multiauth.policies": "basicauth",
+        "userid_hmac_secret": "some-secret-string",
+        "bucket_create_principals": "system.Authenticated",
+        "elasticsearch.hosts": es.host,
+    }
+    testapp = webtest.TestApp(kinto_main({}, **settings))
+    testapp.headers = get_user_headers("bench")
+    testapp.put("/v1/buckets/bid", headers=testapp.headers)
+    testapp.put("/v1/buckets/bid/collections/cid", headers=testapp.headers)
+    return testapp
+
+
+def run(benchmark, func, operations, rounds=10):
+    """Benchmark ``func`` and report throughput, latency percentiles and allocations.
+
+    :param int operations: number of records processed by each call.
+    """
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    benchmark.extra_info["peak_allocated_kb"] = round(peak / 1024, 1)
+
+    result = benchmark.pedantic(func, rounds=rounds, iterations=1, warmup_rounds=1)
+
+    if benchmark.stats is not None:
+        timings = sorted(benchmark.stats.stats.data)
+        for percentile in (50, 95, 99):
+            index = min(len(timings) - 1, len(timings) * percentile // 100)
+            benchmark.extra_info["p%s_ms" % percentile] = round(timings[index] * 1000, 3)
+        mean = benchmark.stats.stats.mean
+        benchmark.extra_info["records_per_second"] = round(operations / mean, 1)
+    return result
@@ -0,0 +1,213 @@
+"""In-process stand-in for an ElasticSearch HTTP server.
+
+It implements the subset of the API used by the plugin, keeps documents in
+memory, and can be configured to answer slowly or to reject bulk requests,
+so that benchmarks measure the plugin and not an actual cluster.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeElasticsearch(object):
+    def __init__(self, latency=0.0, rejection_rate=0.0, seed=42):
+        #: Seconds to wait before answering each request.
+        self.latency = latency
+        #: Ratio of bulk requests answered with ``429 Too Many Requests``.
+        self.rejection_rate = rejection_rate
+        self.random = random.Random(seed)
+        #: Number of rejected bulk requests, as reported by the nodes stats.
+        self.rejected = 0
+        self.indices = {}
+        self.scripts = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def host(self):
+        return "127.0.0.1:{}".format(self.server.server_address[1])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self, latency=0.0, rejection_rate=0.0):
+        with self.lock:
+            self.latency = latency
+            self.rejection_rate = rejection_rate
+            self.rejected = 0
+            self.indices.clear()
+            self.scripts.clear()
+            self.requests.clear()
+
+    def _matching(self, expression):
+        names = set()
+        for pattern in expression.split(","):
+            if pattern.endswith("*"):
+                names.update(n for n in self.indices if n.startswith(pattern[:-1]))
+            elif pattern in self.indices:
+                names.add(pattern)
+        return sorted(names)
+
+    def handle(self, method, path, params, body):
+        """Return the ``(status, payload)`` of the response."""
+        time.sleep(self.latency)
+        parts = [p for p in path.split("/") if p]
+        with self.lock:
+            self.requests.append((method, path))
+
+            if not parts:
+                return 200, {"version": {"number": "7.11.0"}, "tagline": "You Know, for Search"}
+
+            if parts[:2] == ["_cluster", "health"]:
+                return 200, {"cluster_name": "fake", "status": "green"}
+
+            if parts[:2] == ["_cluster", "state"]:
+                if not self.scripts:
+                    return 200, {}
+                return 200, {"metadata": {"stored_scripts": dict(self.scripts)}}
+
+            if parts[0] == "_scripts":
+                script_id = parts[1]
+                if method == "PUT":
+                    self.scripts[script_id] = json.loads(body)["script"]
+                    return 200, {"acknowledged": True}
+                if script_id not in self.scripts:
+                    return 404, {"found": False, "_id": script_id}
+                if method == "DELETE":
+                    del self.scripts[script_id]
+                    return 200, {"acknowledged": True}
+                return 200, {"_id": script_id, "found": True, "script": self.scripts[script_id]}
+
+            if parts[:2] == ["_nodes", "stats"]:
+                pools = {"write": {"threads": 1, "queue": 0, "rejected": self.rejected}}
+                return 200, {"nodes": {"fake": {"thread_pool": pools}}}
+
+            if parts[-1] == "_bulk":
+                if self.random.random() < self.rejection_rate:
+                    self.rejected += 1
+                    error = {"type": "es_rejected_execution_exception", "reason": "rejected"}
+                    return 429, {"error": error, "status": 429}
+                return 200, self._bulk(body)
+
+            if parts[-1] == "_search":
+                return 200, self._search(parts[0], json.loads(body or b"{}"), params)
+
+            if parts[-1] == "_mget":
+                return 200, self._mget(parts[0], json.loads(body))
+
+            if parts[-1] == "_refresh":
+                # Documents are searchable as soon as they are indexed.
+                return 200, {"_shards": {"total": 1, "successful": 1, "failed": 0}}
+
+            if parts[-1] == "_alias":
+                return 200, {name: {"aliases": {}} for name in self._matching(parts[0])}
+
+            if "_mapping" in parts:
+                self.indices.setdefault(parts[0], {})
+                return 200, {"acknowledged": True}
+
+            indexname = parts[0]
+            if method == "HEAD":
+                return (200 if indexname in self.indices else 404), None
+            if method == "PUT":
+                self.indices.setdefault(indexname, {})
+                return 200, {"acknowledged": True, "index": indexname}
+            if method == "DELETE":
+                for name in self._matching(indexname):
+                    del self.indices[name]
+                return 200, {"acknowledged": True}
+
+        return 400, {"error": {"type": "illegal_argument_exception", "reason": path}}
+
+    def _bulk(self, body):
+        lines = body.decode("utf-8").splitlines()
+        items = []
+        position = 0
+        while position < len(lines):
+            action = json.loads(lines[position])
+            position += 1
+            op_type, meta = next(iter(action.items()))
+            documents = self.indices.setdefault(meta["_index"], {})
+            if op_type == "delete":
+                found = documents.pop(meta["_id"], None) is not None
+                status = 200 if found else 404
+            elif op_type == "update":
+                partial = json.loads(lines[position])["doc"]
+                position += 1
+                found = meta["_id"] in documents
+                if found:
+                    documents[meta["_id"]].update(partial)
+                status = 200 if found else 404
+            else:
+                documents[meta["_id"]] = json.loads(lines[position])
+                position += 1
+                status = 201
+            items.append({op_type: {"_index": meta["_index"], "_id": meta["_id"],
+                                    "status": status}})
+        return {"took": 1, "errors": False, "items": items}
+
+    def _search(self, expression, query, params):
+        size = int(params.get("size", query.get("size", 10)))
+        hits = []
+        for indexname in self._matching(expression):
+            for doc_id, source in self.indices[indexname].items():
+                hits.append({"_index": indexname, "_id": doc_id, "_score": 1.0,
+                             "_source": source})
+        return {
+            "took": 1,
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {"total": {"value": len(hits), "relation": "eq"},
+                     "max_score": 1.0,
+                     "hits": hits[:size]},
+        }
+
+    def _mget(self, indexname, query):
+        documents = self.indices.get(indexname, {})
+        docs = []
+        for doc_id in query["ids"]:
+            if doc_id in documents:
+                docs.append({"_index": indexname, "_id": doc_id, "found": True,
+                             "_source": documents[doc_id]})
+            else:
+                docs.append({"_index": indexname, "_id": doc_id, "found": False})
+        return {"docs": docs}
+
+
+def _handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately: avoid delayed ACKs stalls.
+        disable_nagle_algorithm = True
+
+        def _respond(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            status, payload = fake.handle(self.command, url.path, params, body)
+            content = json.dumps(payload).encode("utf-8") if payload is not None else b""
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(content)
+
+        do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _respond
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,65 @@
+import mock
+import pytest
+from kinto.core.cache.memory import Cache
+from kinto.core.events import ACTIONS
+
+from kinto_elasticsearch.command_reindex import reindex_records
+from kinto_elasticsearch.listener import on_record_changed
+from .conftest import BATCH_SIZES, RECORD_SIZES, make_records, run
+
+
+@pytest.mark.parametrize("record_size", RECORD_SIZES)
+@pytest.mark.parametrize("batch_size", BATCH_SIZES)
+def test_bulk(benchmark, indexer, record_size, batch_size):
+    records = make_records(record_size, batch_size)
+
+    def index():
+        with indexer.bulk() as bulk:
+            for record in records:
+                bulk.index_record("bid", "cid", record)
+
+    run(benchmark, index, operations=batch_size)
+
+
+@pytest.mark.parametrize("latency", [0.0, 0.005])
+@pytest.mark.parametrize("rejection_rate", [0.0, 0.2])
+def test_bulk_with_slow_or_rejecting_cluster(benchmark, es, indexer, latency, rejection_rate):
+    es.reset(latency=latency, rejection_rate=rejection_rate)
+    indexer.max_retries = 100
+    records = make_records(256, 2000)
+
+    def index():
+        with indexer.bulk() as bulk:
+            for record in records:
+                bulk.index_record("bid", "cid", record)
+
+    run(benchmark, index, operations=len(records))
+    benchmark.extra_info["final_chunk_size"] = indexer.sizer.chunk_size
+
+
+@pytest.mark.parametrize("record_size", RECORD_SIZES)
+@pytest.mark.parametrize("batch_size", BATCH_SIZES)
+def test_on_record_changed(benchmark, indexer, record_size, batch_size):
+    records = make_records(record_size, batch_size)
+    for timestamp, record in enumerate(records, start=1):
+        record["last_modified"] = timestamp
+    event = mock.MagicMock()
+    event.request.registry.indexer = indexer
+    event.request.registry.cache = Cache(cache_prefix="", cache_max_size_bytes=float("inf"))
+    event.payload = {"bucket_id": "bid", "collection_id": "cid",
+                     "action": ACTIONS.CREATE.value, "timestamp": len(records)}
+    event.impacted_records = [{"new": record} for record in records]
+
+    run(benchmark, lambda: on_record_changed(event), operations=batch_size)
+
+
+@pytest.mark.parametrize("record_size", RECORD_SIZES[:2])
+def test_reindex_records(benchmark, app, indexer, record_size, capsys):
+    storage = app.app.registry.storage
+    for record in make_records(record_size, 2000):
+        storage.create(resource_name="record",
+                       parent_id="/buckets/bid/collections/cid",
+                       obj=record)
+
+    run(benchmark, lambda: reindex_records(indexer, storage, "bid", "cid"),
+        operations=2000, rounds=5)
@@ -0,0 +1,20 @@
+import pytest
+
+from .conftest import make_record, run
+
+
+@pytest.mark.parametrize("latency", [0.0, 0.005])
+@pytest.mark.parametrize("hits", [10, 1000])
+def test_search_view(benchmark, es, app, latency, hits):
+    indexer = app.app.registry.indexer
+    with indexer.bulk() as bulk:
+        for _ in range(hits):
+            bulk.index_record("bid", "cid", make_record(1024))
+    es.latency = latency
+
+    def search():
+        app.post_json("/v1/buckets/bid/collections/cid/search",
+                      {"query": {"match_all": {}}, "size": hits},
+                      headers=app.headers)
+
+    run(benchmark, search, operations=1)
@@ -1,20 +1,37 @@
-import pkg_resources
+try:
+    from importlib.metadata import version
+except ImportError:  # pragma: no cover
+    # Python < 3.8
+    import pkg_resources
 
-from kinto.events import ServerFlushed
-from kinto.core.events import AfterResourceChanged
-
-from . import indexer
-from . import listener
+    def version(distribution_name):
+        return pkg_resources.get_distribution(distribution_name).version
 
 
 #: Module version, as defined in PEP-0396.
-__version__ = pkg_resources.get_distribution(__package__).version
+__version__ = version(__package__)
 
 
 def includeme(config):
+    # Imported here, so that importing the package (eg. for its version) does not
+    # load Kinto, ElasticSearch and pyramid.
+    from kinto.events import ServerFlushed
+    from kinto.core.events import AfterResourceChanged
+    from pyramid.settings import asbool
+
+    from . import indexer
+    from . import listener
+    from . import listing
+
     # Register a global indexer object
     config.registry.indexer = indexer.load_from_config(config)
 
+    # Serve the records listing from the index, when possible.
+    settings = config.get_settings()
+    if asbool(settings.get('elasticsearch.records_listing', 'false')):
+        config.registry.storage = listing.SearchStorage(config.registry.storage,
+                                                        config.registry.indexer)
+
     # Register heartbeat to check elasticsearch integration.
     config.registry.heartbeats["elasticsearch"] = indexer.heartbeat
 
@@ -23,8 +40,12 @@ def includeme(config):
 
     on_record_changed_listener = listener.on_record_changed
 
+    if not asbool(settings.get('elasticsearch.synchronous_indexing', 'true')):
+        # Records are indexed in the background by ``kinto-elasticsearch-daemon``.
+        on_record_changed_listener = listener.on_record_changed_elsewhere
+
     # If StatsD is enabled, monitor execution time of listener.
-    if config.registry.statsd:
+    elif config.registry.statsd:
         statsd_client = config.registry.statsd
         key = 'plugins.elasticsearch.index'
         on_record_changed_listener = statsd_client.timer(key)(on_record_changed_listener)
@@ -0,0 +1,215 @@
+import argparse
+import logging
+import sys
+
+from .command_reindex import DEFAULT_CONFIG_FILE, get_paginated_records
+
+
+logger = logging.getLogger(__package__)
+
+
+def main(cli_args=None):
+    if cli_args is None:
+        cli_args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(
+        description="Compare the records in storage with the indexed documents, "
+                    "and repair the differences.")
+    parser.add_argument('--ini',
+                        help='Application configuration file',
+                        dest='ini_file',
+                        required=False,
+                        default=DEFAULT_CONFIG_FILE)
+    parser.add_argument('-b', '--bucket',
+                        help='Bucket name.',
+                        type=str)
+    parser.add_argument('-c', '--collection',
+                        help='Collection name.',
+                        type=str)
+    parser.add_argument('--dirty',
+                        help='Check the collections whose changes failed to be indexed.',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--dry-run',
+                        help='Only report the differences.',
+                        action='store_true',
+                        default=False)
+    args = parser.parse_args(args=cli_args)
+
+    # Imported once the arguments are parsed, so that ``--help`` is immediate.
+    from kinto.core.storage.exceptions import RecordNotFoundError
+    from pyramid.paster import bootstrap
+
+    from .indexer import get_index_schema
+
+    print("Load config...")
+    env = bootstrap(args.ini_file)
+    registry = env['registry']
+
+    # Make sure that kinto-elasticsearch is configured.
+    try:
+        indexer = registry.indexer
+    except AttributeError:
+        logger.error("kinto-elasticsearch not available.")
+        return 62
+
+    if args.dirty:
+        collections = indexer.dirty_collections(registry.cache)
+        if not args.dry_run:
+            # Cleared first, so that the failures during the checks mark them again.
+            indexer.clear_dirty(registry.cache, collections)
+    else:
+        collections = [(args.bucket, args.collection)]
+
+    message = ("{bucket_id}/{collection_id}: {missing} missing, {stale} stale and "
+               "{orphan} orphan documents {action}.")
+    for bucket_id, collection_id in collections:
+        try:
+            schema = get_index_schema(registry.storage, bucket_id, collection_id)
+        except RecordNotFoundError:
+            logger.error("No collection '%s' in bucket '%s'" % (collection_id, bucket_id))
+            if args.dirty:
+                continue  # Deleted since.
+            return 63
+
+        counts = check_index(indexer, registry.storage, bucket_id, collection_id,
+                             schema=schema, repair=not args.dry_run, cache=registry.cache)
+        print(message.format(bucket_id=bucket_id, collection_id=collection_id,
+                             action="found" if args.dry_run else "repaired", **counts))
+    return 0
+
+
+def iter_stored(storage, bucket_id, collection_id):
+    """Yield the stored records, by descending ``last_modified``."""
+    for records in get_paginated_records(storage, bucket_id, collection_id):
+        yield from records
+
+
+def iter_indexed(indexer, bucket_id, collection_id, size=5000):
+    """Yield the ``(last_modified, id)`` of the indexed documents, by descending
+    ``last_modified``, using ``search_after`` pagination."""
+    import elasticsearch
+
+    body = {
+        "size": size,
+        "_source": False,
+        "sort": [{"last_modified": {"order": "desc", "unmapped_type": "long"}}],
+    }
+    while "not gone through all pages":
+        try:
+            result = indexer.search(bucket_id, collection_id, body=body)
+        except elasticsearch.NotFoundError:
+            return
+        hits = result["hits"]["hits"]
+        for hit in hits:
+            yield hit["sort"][0], hit["_id"]
+
+        if len(hits) < size:
+            break  # Done.
+
+        body["search_after"] = hits[-1]["sort"]
+
+
+def compare(stored, indexed):
+    """Merge the two streams sorted by descending ``last_modified``.
+
+    Yield ``("stored", record)`` for records that are not indexed with the same
+    timestamp (ie. missing or stale), and ``("indexed", (last_modified, id))``
+    for documents that have no stored record with the same timestamp (ie. stale
+    or orphan).
+    """
+    record = next(stored, None)
+    document = next(indexed, None)
+    while record is not None or document is not None:
+        if document is None or (record is not None and
+                                record["last_modified"] > document[0]):
+            yield "stored", record
+            record = next(stored, None)
+        elif record is None or document[0] > record["last_modified"]:
+            yield "indexed", document
+            document = next(indexed, None)
+        else:
+            if record["id"] != document[1]:
+                yield "stored", record
+                yield "indexed", document
+            record = next(stored, None)
+            document = next(indexed, None)
+
+
+def check_index(indexer, storage, bucket_id, collection_id, schema=None, repair=True,
+                batch_size=1000, cache=None):
+    """Compare the stored records with the indexed documents, and repair the index.
+
+    Memory usage is bounded by the size of pages and batches. If a ``cache`` is
+    specified, the collection is marked as dirty if the repair fails, and as
+    indexed once repaired.
+
+    :returns: the number of missing, stale and orphan documents.
+    :rtype: dict
+    """
+    import elasticsearch
+
+    counts = {"missing": 0, "stale": 0, "orphan": 0}
+    to_index = []
+    unmatched = []
+    failed = []
+    # Read before the repair, which indexes the changes up to this point.
+    timestamp = None
+    if repair and cache is not None:
+        timestamp = storage.resource_timestamp(
+            resource_name="record",
+            parent_id="/buckets/%s/collections/%s" % (bucket_id, collection_id))
+
+    def flush():
+        # Unmatched documents that are still stored are stale: their records
+        # are reindexed anyway. The others are orphans.
+        orphans = []
+        if unmatched:
+            stored_ids = _stored_ids(storage, bucket_id, collection_id, unmatched)
+            orphans = [record_id for record_id in unmatched if record_id not in stored_ids]
+            counts["stale"] += len(unmatched) - len(orphans)
+            counts["orphan"] += len(orphans)
+        if repair and (to_index or orphans):
+            try:
+                with indexer.bulk() as bulk:
+                    for record in to_index:
+                        bulk.index_record(bucket_id, collection_id, record=record,
+                                          schema=schema)
+                    for record_id in orphans:
+                        bulk.unindex_record(bucket_id, collection_id, record={"id": record_id})
+            except elasticsearch.ElasticsearchException:
+                logger.exception("Failed to repair documents")
+                failed.append(True)
+                if cache is not None:
+                    indexer.mark_dirty(cache, bucket_id, collection_id)
+        del to_index[:]
+        del unmatched[:]
+
+    stored = iter_stored(storage, bucket_id, collection_id)
+    indexed = iter_indexed(indexer, bucket_id, collection_id)
+    for side, item in compare(stored, indexed):
+        if side == "stored":
+            to_index.append(item)
+            counts["missing"] += 1
+        else:
+            unmatched.append(item[1])
+        if len(to_index) + len(unmatched) >= batch_size:
+            flush()
+    flush()
+    if timestamp is not None and not failed:
+        indexer.mark_indexed(cache, bucket_id, collection_id, timestamp)
+
+    # Stale records were counted as missing too.
+    counts["missing"] -= counts["stale"]
+    return counts
+
+
+def _stored_ids(storage, bucket_id, collection_id, record_ids):
+    from kinto.core.storage import Filter
+    from kinto.core.utils import COMPARISON
+
+    parent_id = "/buckets/%s/collections/%s" % (bucket_id, collection_id)
+    records = storage.list_all(resource_name="record",
+                               parent_id=parent_id,
+                               filters=[Filter("id", record_ids, COMPARISON.IN)])
+    return set(record["id"] for record in records)
@@ -0,0 +1,260 @@
+import argparse
+import logging
+import sys
+import time
+
+from .command_reindex import DEFAULT_CONFIG_FILE, load_lightweight
+
+
+logger = logging.getLogger(__package__)
+
+
+def main(cli_args=None):
+    if cli_args is None:
+        cli_args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(
+        description="Index the changes of the storage in the background, "
+                    "instead of during the requests.")
+    parser.add_argument('--ini',
+                        help='Application configuration file',
+                        dest='ini_file',
+                        required=False,
+                        default=DEFAULT_CONFIG_FILE)
+    parser.add_argument('--interval',
+                        help='Seconds to wait between two passes on the collections.',
+                        type=float,
+                        default=5.0)
+    parser.add_argument('--batch-size',
+                        help='Maximum number of changes sent per bulk request.',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--once',
+                        help='Index the pending changes and exit.',
+                        action='store_true',
+                        default=False)
+    args = parser.parse_args(args=cli_args)
+
+    print("Load config...")
+    storage, cache, indexer = load_lightweight(args.ini_file)
+
+    # Make sure that kinto-elasticsearch is configured.
+    if indexer is None:
+        logger.error("kinto-elasticsearch not available.")
+        return 62
+
+    tailer = Tailer(indexer, storage, batch_size=args.batch_size, cache=cache)
+    try:
+        while "not interrupted":
+            total = tailer.run()
+            if args.once:
+                print("%s changes indexed." % total)
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+class Tailer(object):
+    """Follow the changes of every collection using their ``last_modified`` field.
+
+    The position of each collection is kept in memory, and in the cache backend
+    if specified (see :meth:`Indexer.mark_indexed`). When a collection is first
+    seen, it starts from the stored position, or from the latest change already
+    indexed, so that restarting the daemon only sends the changes since it stopped.
+
+    Buckets and collections are followed the same way, tombstones included: only
+    their changes since the previous pass are read, and indices are deleted when
+    the deletion of their collection (or bucket) is read.
+    """
+    def __init__(self, indexer, storage, batch_size=1000, cache=None):
+        self.indexer = indexer
+        self.storage = storage
+        self.batch_size = batch_size
+        self.cache = cache
+        #: Latest timestamp of the buckets changes read.
+        self.buckets_checkpoint = None
+        #: Latest timestamp of the collections changes read, by bucket id.
+        self.buckets = {}
+        #: Index schema of the stored collections, by ``(bucket_id, collection_id)``.
+        self.collections = {}
+        #: Latest timestamp indexed, by ``(bucket_id, collection_id)``.
+        self.checkpoints = {}
+        #: Index schema, by ``(bucket_id, collection_id)``.
+        self.schemas = {}
+        #: Deleted collections whose indices are not deleted yet.
+        self.deleted = set()
+
+    def run(self):
+        """Index the pending changes of every collection.
+
+        :returns: the number of indexed changes.
+        :rtype: int
+        """
+        import elasticsearch
+        from kinto.core.utils import msec_time
+
+        started = msec_time()
+        total = 0
+        failed = False
+        self.list_changes()
+        if self.deleted:
+            try:
+                self.indexer.delete_indices(collections=sorted(self.deleted))
+            except elasticsearch.ElasticsearchException:
+                # Retried on the next pass.
+                logger.exception("Failed to delete indices")
+                failed = True
+            else:
+                self.deleted.clear()
+        for (bucket_id, collection_id), schema in self.collections.items():
+            if (bucket_id, collection_id) in self.deleted:
+                continue  # Recreated, but its previous index is not deleted yet.
+            try:
+                self.follow(bucket_id, collection_id, schema)
+                total += self.tail(bucket_id, collection_id)
+            except elasticsearch.ElasticsearchException:
+                # Retried on the next pass, from the same checkpoint.
+                logger.exception("Failed to index changes of %s/%s",
+                                 bucket_id, collection_id)
+                failed = True
+        if self.cache is not None and not failed:
+            # Checked by the heartbeat (see ``elasticsearch.heartbeat.max_indexing_lag``).
+            self.indexer.mark_caught_up(self.cache, started)
+        return total
+
+    def list_changes(self):
+        """Read the buckets and collections changed since the previous pass.
+
+        Indices are only deleted when a tombstone is read, never because a collection
+        is missing from a listing.
+        """
+        for bucket in self.changes("bucket", "", self.buckets_checkpoint):
+            self.buckets_checkpoint = bucket["last_modified"]
+            if bucket.get("deleted"):
+                # Its collections are purged without tombstones.
+                self.buckets.pop(bucket["id"], None)
+                self.forget([key for key in self.collections if key[0] == bucket["id"]])
+            else:
+                self.buckets.setdefault(bucket["id"], None)
+
+        for bucket_id in self.buckets:
+            parent_id = "/buckets/%s" % bucket_id
+            for collection in self.changes("collection", parent_id, self.buckets[bucket_id]):
+                self.buckets[bucket_id] = collection["last_modified"]
+                key = (bucket_id, collection["id"])
+                if collection.get("deleted"):
+                    self.forget([key])
+                else:
+                    self.collections[key] = collection.get("index:schema")
+
+    def changes(self, resource_name, parent_id, since=None):
+        """Yield the objects and tombstones modified after ``since``, by ascending
+        ``last_modified``.
+
+        The backends return at most ``storage_max_fetch_size`` objects per call, so the
+        pages are read until an empty one.
+        """
+        from kinto.core.storage import Sort, Filter
+        from kinto.core.utils import COMPARISON
+
+        while "not gone through all pages":
+            filters = []
+            if since is not None:
+                filters = [Filter("last_modified", since, COMPARISON.GT)]
+            objects = self.storage.list_all(resource_name=resource_name,
+                                            parent_id=parent_id,
+                                            filters=filters,
+                                            sorting=[Sort("last_modified", 1)],
+                                            include_deleted=True,
+                                            limit=self.batch_size)
+            if not objects:
+                break  # Done.
+            yield from objects
+            since = objects[-1]["last_modified"]
+
+    def forget(self, keys):
+        """Stop following the collections, and schedule the deletion of their indices."""
+        for key in keys:
+            self.collections.pop(key, None)
+            self.checkpoints.pop(key, None)
+            self.schemas.pop(key, None)
+            if self.cache is not None:
+                self.indexer.invalidate_indexed(self.cache, *key)
+            self.deleted.add(key)
+
+    def follow(self, bucket_id, collection_id, schema):
+        """Create the index of new collections, and update it if the schema changed."""
+        key = (bucket_id, collection_id)
+        if key not in self.checkpoints:
+            self.indexer.create_index(bucket_id, collection_id, schema=schema)
+            checkpoint = None
+            if self.cache is not None:
+                checkpoint = self.indexer.indexed_timestamp(self.cache, bucket_id, collection_id)
+            if checkpoint is None:
+                checkpoint = self.last_indexed(bucket_id, collection_id)
+            self.checkpoints[key] = checkpoint
+        elif self.schemas[key] != schema:
+            self.indexer.update_index(bucket_id, collection_id, schema=schema)
+        self.schemas[key] = schema
+
+    def last_indexed(self, bucket_id, collection_id):
+        """Return the highest ``last_modified`` of the indexed documents."""
+        body = {"size": 0, "aggs": {"latest": {"max": {"field": "last_modified"}}}}
+        result = self.indexer.search(bucket_id, collection_id, body=body)
+        return result["aggregations"]["latest"]["value"] or 0
+
+    def tail(self, bucket_id, collection_id):
+        """Index the changes of the collection since its checkpoint, by batches.
+
+        :returns: the number of indexed changes.
+        :rtype: int
+        """
+        from kinto.core.storage import Sort, Filter
+        from kinto.core.utils import COMPARISON
+
+        key = (bucket_id, collection_id)
+        parent_id = "/buckets/%s/collections/%s" % (bucket_id, collection_id)
+        total = 0
+        while "not caught up":
+            changes = self.storage.list_all(
+                resource_name="record",
+                parent_id=parent_id,
+                filters=[Filter("last_modified", self.checkpoints[key], COMPARISON.GT)],
+                sorting=[Sort("last_modified", 1)],
+                include_deleted=True,
+                limit=self.batch_size)
+            if not changes:
+                break  # Done.
+
+            self.index(bucket_id, collection_id, changes)
+            # Only moved once the changes are indexed.
+            self.checkpoints[key] = changes[-1]["last_modified"]
+            if self.cache is not None:
+                self.indexer.mark_indexed(self.cache, bucket_id, collection_id,
+                                          self.checkpoints[key])
+            total += len(changes)
+
+            if len(changes) < self.batch_size:
+                break  # Done.
+        return total
+
+    def index(self, bucket_id, collection_id, changes):
+        # Deleting documents that are not indexed would fail the bulk request,
+        # and the indexed hashes let unchanged records be skipped.
+        indexed = self.indexer.get_hashes(bucket_id, collection_id,
+                                          [change["id"] for change in changes])
+        schema = self.schemas[(bucket_id, collection_id)]
+        with self.indexer.bulk() as bulk:
+            for change in changes:
+                if change.get("deleted"):
+                    if change["id"] in indexed:
+                        bulk.unindex_record(bucket_id, collection_id, record=change)
+                    continue
+                previous_hash = indexed.get(change["id"]) if self.indexer.skip_unchanged else None
+                bulk.index_record(bucket_id,
+                                  collection_id,
+                                  record=change,
+                                  schema=schema,
+                                  previous_hash=previous_hash)
@@ -1,14 +1,7 @@
 import argparse
-import elasticsearch
 import logging
 import sys
 
-from pyramid.paster import bootstrap
-
-from kinto.core.storage.exceptions import RecordNotFoundError
-from kinto.core.storage import Sort, Filter
-from kinto.core.utils import COMPARISON
-
 
 DEFAULT_CONFIG_FILE = 'config/kinto.ini'
 
@@ -31,16 +24,34 @@ def main(cli_args=None):
     parser.add_argument('-c', '--collection',
                         help='Collection name.',
                         type=str)
+    parser.add_argument('--keep-index',
+                        help='Only send changed records to the existing index '
+                             '(requires elasticsearch.skip_unchanged).',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--lightweight',
+                        help='Only open the storage backend and ElasticSearch, '
+                             'without loading the whole application.',
+                        action='store_true',
+                        default=False)
     args = parser.parse_args(args=cli_args)
 
+    # Imported once the arguments are parsed, so that ``--help`` is immediate.
+    from kinto.core.storage.exceptions import RecordNotFoundError
+    from pyramid.paster import bootstrap
+
+    from .indexer import get_index_schema
+
     print("Load config...")
-    env = bootstrap(args.ini_file)
-    registry = env['registry']
+    if args.lightweight:
+        storage, _, indexer = load_lightweight(args.ini_file)
+    else:
+        registry = bootstrap(args.ini_file)['registry']
+        storage = registry.storage
+        indexer = getattr(registry, "indexer", None)
 
     # Make sure that kinto-elasticsearch is configured.
-    try:
-        indexer = registry.indexer
-    except AttributeError:
+    if indexer is None:
         logger.error("kinto-elasticsearch not available.")
         return 62
 
@@ -49,7 +60,7 @@ def main(cli_args=None):
 
     # Get index schema from collection metadata.
     try:
-        schema = get_index_schema(registry.storage, bucket_id, collection_id)
+        schema = get_index_schema(storage, bucket_id, collection_id)
     except RecordNotFoundError:
         logger.error("No collection '%s' in bucket '%s'" % (collection_id, bucket_id))
         return 63
@@ -59,20 +70,47 @@ def main(cli_args=None):
         logger.error("No `index:schema` attribute found in collection metadata.")
         return 64
 
-    # XXX: Are you sure?
-    recreate_index(indexer, bucket_id, collection_id, schema)
-    reindex_records(indexer, registry.storage, bucket_id, collection_id)
+    if args.keep_index:
+        # Create the index if missing, or update its mapping.
+        indexer.create_index(bucket_id, collection_id, schema=schema)
+    else:
+        # XXX: Are you sure?
+        recreate_index(indexer, bucket_id, collection_id, schema)
+    reindex_records(indexer, storage, bucket_id, collection_id, schema=schema)
 
     return 0
 
 
-def get_index_schema(storage, bucket_id, collection_id):
-    # Open collection metadata.
-    # XXX: https://github.com/Kinto/kinto/issues/710
-    metadata = storage.get(parent_id="/buckets/%s" % bucket_id,
-                           collection_id="collection",
-                           object_id=collection_id)
-    return metadata.get("index:schema")
+def load_lightweight(ini_file):
+    """Return the storage and cache backends, and the indexer configured in the
+    ini file, without including Kinto views and plugins.
+
+    :returns: ``(storage, cache, indexer)``, with ``indexer`` being ``None`` if
+        the plugin is not included.
+    """
+    import kinto
+    import kinto.core
+    from kinto.core.initialization import load_default_settings
+    from pyramid.config import Configurator
+    from pyramid.paster import get_appsettings
+    from pyramid.settings import aslist
+
+    from .indexer import load_from_config
+
+    config = Configurator(settings=get_appsettings(ini_file))
+    config.add_settings({"settings_prefix": "kinto"})
+    load_default_settings(config, {**kinto.core.DEFAULT_SETTINGS, **kinto.DEFAULT_SETTINGS})
+    settings = config.get_settings()
+
+    backend = config.maybe_dotted(settings["storage_backend"])
+    storage = backend.load_from_config(config)
+    backend = config.maybe_dotted(settings["cache_backend"])
+    cache = backend.load_from_config(config)
+    if __package__ not in aslist(settings.get("includes", "")):
+        return storage, cache, None
+    config.registry.statsd = None
+    config.registry.cache = cache
+    return storage, cache, load_from_config(config)
 
 
 def recreate_index(indexer, bucket_id, collection_id, schema):
@@ -86,16 +124,19 @@ def recreate_index(indexer, bucket_id, collection_id, schema):
 
 
 def get_paginated_records(storage, bucket_id, collection_id, limit=5000):
+    from kinto.core.storage import Sort, Filter
+    from kinto.core.utils import COMPARISON
+
     # We can reach the storage_fetch_limit, so we use pagination.
     parent_id = "/buckets/%s/collections/%s" % (bucket_id, collection_id)
     sorting = [Sort('last_modified', -1)]
     pagination_rules = []
     while "not gone through all pages":
-        records, _ = storage.get_all(parent_id=parent_id,
-                                     collection_id="record",
-                                     pagination_rules=pagination_rules,
-                                     sorting=sorting,
-                                     limit=limit)
+        records = storage.list_all(resource_name="record",
+                                   parent_id=parent_id,
+                                   pagination_rules=pagination_rules,
+                                   sorting=sorting,
+                                   limit=limit)
 
         yield records
 
@@ -108,17 +149,64 @@ def get_paginated_records(storage, bucket_id, collection_id, limit=5000):
         ]
 
 
-def reindex_records(indexer, storage, bucket_id, collection_id):
+def get_records_pages(storage, bucket_id, collection_id):
+    """Yield the records of the collection by pages, in no particular order."""
+    from .listing import SearchStorage
+
+    if isinstance(storage, SearchStorage):
+        storage = storage.storage
+    if type(storage).__module__ == "kinto.core.storage.postgresql":
+        return stream_records(storage, bucket_id, collection_id)
+    return get_paginated_records(storage, bucket_id, collection_id)
+
+
+def stream_records(storage, bucket_id, collection_id, limit=5000):
+    """Yield pages of records read from PostgreSQL with a server-side cursor.
+
+    A single query is run for the whole collection, without sorting or filtering
+    on ``last_modified`` for every page.
+    """
+    from kinto.core.utils import sqlalchemy
+
+    query = """
+        SELECT id, as_epoch(last_modified) AS last_modified, data
+          FROM objects
+         WHERE parent_id = :parent_id
+           AND resource_name = 'record'
+           AND NOT deleted;
+    """
+    parent_id = "/buckets/%s/collections/%s" % (bucket_id, collection_id)
+    statement = sqlalchemy.text(query).execution_options(stream_results=True)
+    with storage.client.connect(readonly=True) as conn:
+        result = conn.execute(statement, dict(parent_id=parent_id))
+        while "not gone through all rows":
+            rows = result.fetchmany(limit)
+            if not rows:
+                break  # Done.
+            yield [dict(row["data"], id=row["id"], last_modified=row["last_modified"])
+                   for row in rows]
+
+
+def reindex_records(indexer, storage, bucket_id, collection_id, schema=None):
+    import elasticsearch
+
     total = 0
-    for records in get_paginated_records(storage, bucket_id, collection_id):
+    for records in get_records_pages(storage, bucket_id, collection_id):
         try:
+            hashes = {}
+            if indexer.skip_unchanged:
+                record_ids = [record["id"] for record in records]
+                hashes = indexer.get_hashes(bucket_id, collection_id, record_ids)
             with indexer.bulk() as bulk:
                 for record in records:
+                    previous_hash = hashes.get(record["id"]) if hashes else None
                     bulk.index_record(bucket_id,
                                       collection_id,
-                                      record=record)
+                                      record=record,
+                                      schema=schema,
+                                      previous_hash=previous_hash)
                 print(".", end="")
-            total += len(bulk.operations)
+            total += len(bulk)
         except elasticsearch.ElasticsearchException:
             logger.exception("Failed to index record")
     print("\n%s records reindexed." % total)
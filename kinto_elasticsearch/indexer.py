@@ -1,90 +1,852 @@
+import collections
+import hashlib
+import itertools
+import json
 import logging
-from contextlib import contextmanager
+import math
+import threading
+import time
+from contextlib import contextmanager, ExitStack
 
 import elasticsearch
-import elasticsearch.helpers
+from kinto.core.storage.exceptions import RecordNotFoundError
+from kinto.core.utils import msec_time
+from pyramid.exceptions import ConfigurationError
 from pyramid.settings import aslist, asbool
 
 
 logger = logging.getLogger(__name__)
 
+# Document field holding the hash of the indexed record content.
+HASH_FIELD = "index:hash"
+
+# Keep multi-index URLs below the default ``http.max_initial_line_length`` (4kB).
+MAX_INDICES_LENGTH = 3000
+
+# Cluster health statuses, from worst to best.
+HEALTH_STATUSES = ("red", "yellow", "green")
+
+# Status codes of bulk requests refused by the cluster (queue full or payload too large).
+REJECTION_STATUSES = (413, 429)
+
+# Upper bound, in seconds, of the delay before retrying a rejected bulk request.
+MAX_RETRY_BACKOFF = 60
+
+# Seconds during which the latest indexed timestamp of a collection is remembered.
+INDEXED_TTL = 30 * 24 * 3600
+
+
+class CircuitOpenError(elasticsearch.ElasticsearchException):
+    """Raised instead of calling ElasticSearch while the circuit breaker is open."""
+    def __init__(self, retry_after):
+        super().__init__("Circuit breaker is open, retry after {}s".format(retry_after))
+        self.retry_after = retry_after
+
+
+class BulkSizer(object):
+    """Adapt the number of operations sent per bulk request.
+
+    The chunk size grows additively while ElasticSearch answers within the
+    target duration, and is halved as soon as a request is slow or rejected.
+    """
+    def __init__(self, initial=500, minimum=10, maximum=5000, increment=50,
+                 target_duration=1.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increment = increment
+        self.target_duration = target_duration
+        self.chunk_size = max(minimum, min(initial, maximum))
+
+    def succeeded(self, duration):
+        if duration > self.target_duration:
+            self.rejected()
+        else:
+            self.chunk_size = min(self.chunk_size + self.increment, self.maximum)
+
+    def rejected(self):
+        self.chunk_size = max(self.chunk_size // 2, self.minimum)
+
+
+class CircuitBreaker(object):
+    """Fail fast while ElasticSearch is unavailable or too slow.
+
+    The breaker opens when the ratio of failed (or slow) calls among the last
+    ``window`` calls reaches ``failure_rate``. Calls are then refused for
+    ``reset_timeout`` seconds, after which a single probe call is let through
+    (half-open): it closes the breaker if it succeeds, and opens it again otherwise.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_rate=0.5, window=20, slow_call_duration=None,
+                 reset_timeout=30):
+        self.failure_rate = failure_rate
+        self.slow_call_duration = slow_call_duration
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.outcomes = collections.deque(maxlen=window)
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def retry_after(self):
+        """Seconds until the next probe call is allowed."""
+        remaining = self._opened_at + self.reset_timeout - time.time()
+        return max(int(math.ceil(remaining)), 0)
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            # Let a probe through, or another one if the last probe never completed.
+            if time.time() >= self._opened_at + self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._opened_at = time.time()
+                return True
+            return False
+
+    def record(self, duration, failed=False, started=None):
+        """Record the outcome of a call.
+
+        Only the probe decides while half-open: the outcomes of the calls that were
+        in flight when the breaker opened (or that started before the probe) are
+        ignored.
+
+        :returns: ``True`` if this call opened the breaker.
+        """
+        if self.slow_call_duration is not None and duration > self.slow_call_duration:
+            failed = True
+        with self._lock:
+            if self.state == self.OPEN:
+                return False
+            if self.state == self.HALF_OPEN:
+                if started is not None and started < self._opened_at:
+                    return False
+                if failed:
+                    self._opened_at = time.time()
+                    self.state = self.OPEN
+                else:
+                    self.state = self.CLOSED
+                    self.outcomes.clear()
+                return False
+            self.outcomes.append(failed)
+            if (len(self.outcomes) == self.outcomes.maxlen and
+                    sum(self.outcomes) >= self.failure_rate * len(self.outcomes)):
+                self._opened_at = time.time()
+                self.state = self.OPEN
+                return True
+            return False
+
 
 class Indexer(object):
-    def __init__(self, hosts, prefix="kinto", force_refresh=False):
-        self.client = elasticsearch.Elasticsearch(hosts)
+    def __init__(self, hosts, prefix="kinto", force_refresh=False,
+                 max_chunk_bytes=10 * 1024 * 1024, max_retries=3, sizer=None,
+                 skip_unchanged=False, schema_fields_only=False, metadata_ttl=300,
+                 statsd=None, tracer=None, circuit_breaker=None, dirty_ttl=7 * 24 * 3600,
+                 search_hosts=None, mirrors=(), facets_ttl=3600, suggest_ttl=10,
+                 timeout=None, records_listing=False, retry_backoff=1.0):
+        self.hosts = hosts
+        # Requests timeout in seconds (the client default if ``None``).
+        self.timeout = timeout
+        # Searches can be sent to other nodes (eg. coordinating or replica-heavy).
+        self.search_hosts = search_hosts or None
+        self._client = None
+        self._search_client = None
+        # Indexers of the other clusters that receive every write (see :meth:`_mirror`).
+        self.mirrors = list(mirrors)
         self.prefix = prefix
         self.force_refresh = force_refresh
+        # When the index serves the records listing (see :class:`SearchStorage`), bulk
+        # requests wait for the documents to be searchable, and the ``last_modified``
+        # of skipped records is kept up to date, since listings are sorted with it.
+        self.records_listing = records_listing
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        # Initial delay in seconds before retrying a rejected bulk request (doubled
+        # on each consecutive rejection).
+        self.retry_backoff = retry_backoff
+        self.sizer = sizer or BulkSizer()
+        self.skip_unchanged = skip_unchanged
+        self.schema_fields_only = schema_fields_only
+        self.metadata_ttl = metadata_ttl
+        self.statsd = statsd
+        self.tracer = tracer
+        # Optional :class:`CircuitBreaker` guarding the calls to the cluster.
+        self.circuit_breaker = circuit_breaker
+        self.dirty_ttl = dirty_ttl
+        self.facets_ttl = facets_ttl
+        self.suggest_ttl = suggest_ttl
+        # Optional :class:`HealthCheck` used by the heartbeat.
+        self.health_check = None
+        # Optional :class:`Throttle` of the suggestions requests.
+        self.suggest_throttle = None
+        # Compiled fields of each index schema, by index name.
+        self._projections = {}
+        # Collections metadata (version, expiration, metadata), by index name.
+        self._collections = {}
+
+    @property
+    def client(self):
+        """ElasticSearch client, created on first use.
+
+        Nothing is built while the application loads (eg. in the master process,
+        before workers fork and would share its connections pools).
+        """
+        if self._client is None:
+            self._client = self._connect(self.hosts)
+        return self._client
+
+    @property
+    def search_client(self):
+        if self.search_hosts is None:
+            return self.client
+        if self._search_client is None:
+            self._search_client = self._connect(self.search_hosts)
+        return self._search_client
+
+    def _connect(self, hosts):
+        if self.timeout is None:
+            return elasticsearch.Elasticsearch(hosts)
+        return elasticsearch.Elasticsearch(hosts, timeout=self.timeout)
+
+    @contextmanager
+    def instrument(self, operation, **attributes):
+        """Measure the block with a StatsD timer and a tracing span, when enabled."""
+        with ExitStack() as stack:
+            if self.tracer is not None:
+                name = "elasticsearch.{}".format(operation)
+                stack.enter_context(self.tracer.start_as_current_span(name,
+                                                                      attributes=attributes))
+            if self.statsd is not None:
+                key = "plugins.elasticsearch.{}".format(operation)
+                stack.enter_context(self.statsd.timer(key))
+            yield
+
+    @contextmanager
+    def guard(self):
+        """Fail fast while the circuit breaker is open, and record the outcome of the block.
+
+        Only unavailability (connection errors, timeouts and server errors) counts as
+        a failure: rejections and invalid requests mean that the cluster answers.
+        """
+        breaker = self.circuit_breaker
+        if breaker is None:
+            yield
+            return
+        if not breaker.allow():
+            self.count("circuit_breaker.rejections")
+            raise CircuitOpenError(breaker.retry_after)
+        started = time.time()
+        failed = False
+        try:
+            yield
+        except elasticsearch.TransportError as e:
+            failed = (isinstance(e, elasticsearch.ConnectionError) or
+                      (isinstance(e.status_code, int) and e.status_code >= 500))
+            raise
+        finally:
+            if breaker.record(time.time() - started, failed=failed, started=started):
+                logger.warning("ElasticSearch circuit breaker opened for %ss",
+                               breaker.reset_timeout)
+                self.count("circuit_breaker.opened")
+
+    def count(self, metric, value=1):
+        if self.statsd is not None:
+            self.statsd.count("plugins.elasticsearch.{}".format(metric), value)
 
     def indexname(self, bucket_id, collection_id):
         return "{}-{}-{}".format(self.prefix, bucket_id, collection_id)
 
+    def _mirror(self, method, *args, **kwargs):
+        """Apply the write to the dual-write clusters, once applied to the primary one.
+
+        Their failures are logged and counted, but never raised: the primary
+        cluster remains the reference (see ``kinto-elasticsearch-check``). Each
+        mirror has its own circuit breaker, so that a cluster which is down does
+        not slow down every write.
+        """
+        for mirror in self.mirrors:
+            try:
+                getattr(mirror, method)(*args, **kwargs)
+            except CircuitOpenError:
+                self.count("mirrors.skipped")
+            except elasticsearch.ElasticsearchException:
+                logger.exception("Failed to %s on dual-write cluster %s",
+                                 method, mirror.client.transport.hosts)
+                self.count("mirrors.failures")
+
     def create_index(self, bucket_id, collection_id, schema=None):
+        try:
+            return self._create_index(bucket_id, collection_id, schema)
+        finally:
+            self._mirror("create_index", bucket_id, collection_id, schema)
+
+    def _create_index(self, bucket_id, collection_id, schema=None):
         indexname = self.indexname(bucket_id, collection_id)
         # Only if necessary.
-        if not self.client.indices.exists(index=indexname):
+        with self.guard(), self.instrument("indices.exists", index=indexname):
+            exists = self.client.indices.exists(index=indexname)
+        if not exists:
             if schema:
-                body = {"mappings": {indexname: schema}}
+                body = {"mappings": {indexname: self._mapping(schema)}}
             else:
                 body = None
-            return self.client.indices.create(index=indexname, body=body)
+            self.count("indices.create")
+            with self.guard(), self.instrument("indices.create", index=indexname):
+                return self.client.indices.create(index=indexname, body=body)
         else:
-            return self.update_index(bucket_id, collection_id, schema)
+            return self._update_index(bucket_id, collection_id, schema)
 
     def update_index(self, bucket_id, collection_id, schema=None):
+        try:
+            self._update_index(bucket_id, collection_id, schema)
+        finally:
+            self._mirror("update_index", bucket_id, collection_id, schema)
+
+    def _update_index(self, bucket_id, collection_id, schema=None):
         indexname = self.indexname(bucket_id, collection_id)
         if schema is None:
             schema = {"properties": {}}
-        self.client.indices.put_mapping(index=indexname,
-                                        doc_type=indexname,
-                                        body=schema)
+        self.count("indices.put_mapping")
+        with self.guard(), self.instrument("indices.put_mapping", index=indexname):
+            self.client.indices.put_mapping(index=indexname,
+                                            doc_type=indexname,
+                                            body=self._mapping(schema))
+
+    def _mapping(self, schema):
+        if not self.skip_unchanged:
+            return schema
+        # The hash is only read back from the source, never searched.
+        properties = dict(schema.get("properties", {}))
+        properties[HASH_FIELD] = {"type": "keyword", "index": False, "doc_values": False}
+        return dict(schema, properties=properties)
 
     def delete_index(self, bucket_id, collection_id=None):
         if collection_id is None:
-            collection_id = "*"
+            self.delete_indices(bucket_ids=[bucket_id])
+        else:
+            self.delete_indices(collections=[(bucket_id, collection_id)])
+
+    def delete_indices(self, bucket_ids=(), collections=(), keep=()):
+        """Delete the indices of the specified buckets and ``(bucket_id, collection_id)``
+        pairs, with as few requests as possible.
+
+        Bucket indices are resolved to concrete names first, since wildcard deletions
+        are rejected by clusters with ``action.destructive_requires_name``. Since ids
+        can contain ``-``, the indices of bucket ``a`` also match those of bucket
+        ``a-b``: the indices of the other collections must be specified in ``keep``.
+        """
+        try:
+            self._delete_bucket_indices(bucket_ids, collections, keep)
+        finally:
+            self._mirror("delete_indices", bucket_ids=bucket_ids, collections=collections,
+                         keep=keep)
+
+    def _delete_bucket_indices(self, bucket_ids, collections, keep):
+        indexnames = [self.indexname(bucket_id, collection_id)
+                      for bucket_id, collection_id in collections]
+        patterns = [self.indexname(bucket_id, "*") for bucket_id in bucket_ids]
+        indexnames.extend(name for name in self._resolve_indices(patterns)
+                          if name not in keep)
+
+        prefixes = tuple(indexnames) + tuple(p.rstrip("*") for p in patterns)
+        for cached in [name for name in self._projections if name.startswith(prefixes)]:
+            del self._projections[cached]
+
+        self._delete_indices(indexnames)
+        if bucket_ids:
+            # The search templates of the bucket collections are not deleted one by one.
+            self._delete_scripts(tuple(p.rstrip("*") for p in patterns), keep)
+
+    def _delete_indices(self, indexnames):
+        for chunk in _join_indices(indexnames):
+            self.count("indices.delete")
+            with self.guard(), self.instrument("indices.delete", index=chunk):
+                self.client.indices.delete(index=chunk, ignore_unavailable=True)
+
+    def _delete_scripts(self, prefixes, keep=()):
+        """Delete the search templates of the indices whose name starts with one of
+        ``prefixes``, except those of the indices in ``keep``."""
+        with self.guard(), self.instrument("cluster.state"):
+            state = self.client.cluster.state(metric="metadata",
+                                              filter_path="metadata.stored_scripts")
+        scripts = state.get("metadata", {}).get("stored_scripts", {})
+        for script_id in scripts:
+            # See :meth:`templatename`.
+            indexname = script_id.split(".", 1)[0]
+            if not indexname.startswith(prefixes) or indexname in keep:
+                continue
+            self.count("scripts.delete")
+            with self.guard(), self.instrument("delete_script", id=script_id):
+                self.client.delete_script(id=script_id, ignore=404)
+
+    def _resolve_indices(self, patterns):
+        indexnames = []
+        for chunk in _join_indices(patterns):
+            with self.guard(), self.instrument("indices.get_alias", index=chunk):
+                indexnames.extend(self.client.indices.get_alias(index=chunk).keys())
+        return indexnames
+
+    def get_collection(self, storage, cache, bucket_id, collection_id):
+        """Return the collection metadata, or ``None`` if it does not exist.
+
+        Metadata is kept in process until it expires, or until the version of the
+        bucket collections stored in the cache backend changes (see
+        :meth:`invalidate_collections`), so that the listeners do not hit the
+        storage on every write.
+        """
+        # Read the version first: a concurrent change will invalidate what we fetch.
+        version = cache.get(self._collections_version_key(bucket_id))
         indexname = self.indexname(bucket_id, collection_id)
+        cached = self._collections.get(indexname)
+        now = time.time()
+        if cached is not None and cached[0] == version and cached[1] > now:
+            self.count("metadata.hits")
+            return cached[2]
+        self.count("metadata.misses")
         try:
-            return self.client.indices.delete(index=indexname)
-        except elasticsearch.exceptions.NotFoundError:  # pragma: no cover
-            pass
+            metadata = storage.get(resource_name="collection",
+                                   parent_id="/buckets/%s" % bucket_id,
+                                   object_id=collection_id)
+        except RecordNotFoundError:
+            metadata = None
+        self._collections[indexname] = (version, now + self.metadata_ttl, metadata)
+        return metadata
+
+    def invalidate_collections(self, cache, bucket_id):
+        """Drop the cached metadata of the bucket collections, in every process."""
+        prefix = self.indexname(bucket_id, "")
+        for cached in [name for name in self._collections if name.startswith(prefix)]:
+            del self._collections[cached]
+        # Local entries expire before this key, hence never outlive a version change.
+        cache.set(self._collections_version_key(bucket_id), msec_time(), self.metadata_ttl)
+
+    def mark_dirty(self, cache, bucket_id, collection_id):
+        """Remember that some changes of the collection may not be indexed.
+
+        Dirty collections are repaired with ``kinto-elasticsearch-check --dirty``.
+        """
+        key = self._dirty_key()
+        dirty = cache.get(key) or []
+        if [bucket_id, collection_id] not in dirty:
+            dirty.append([bucket_id, collection_id])
+        cache.set(key, dirty, self.dirty_ttl)
+        # The index cannot be trusted anymore, whatever is indexed afterwards.
+        cache.delete(self._indexed_key(bucket_id, collection_id))
+
+    def dirty_collections(self, cache):
+        """Return the ``(bucket_id, collection_id)`` marked as dirty."""
+        return [tuple(pair) for pair in cache.get(self._dirty_key()) or []]
+
+    def clear_dirty(self, cache, collections):
+        key = self._dirty_key()
+        cleared = [list(pair) for pair in collections]
+        dirty = [pair for pair in cache.get(key) or [] if pair not in cleared]
+        if dirty:
+            cache.set(key, dirty, self.dirty_ttl)
+        else:
+            cache.delete(key)
+
+    def mark_indexed(self, cache, bucket_id, collection_id, timestamp):
+        """Remember that the changes of the collection up to ``timestamp`` are indexed.
+
+        Only moves forward, and is ignored while the collection is dirty.
+        """
+        if (bucket_id, collection_id) in self.dirty_collections(cache):
+            return
+        key = self._indexed_key(bucket_id, collection_id)
+        current = cache.get(key)
+        if current is None or current < timestamp:
+            cache.set(key, timestamp, INDEXED_TTL)
+
+    def indexed_timestamp(self, cache, bucket_id, collection_id):
+        """Return the timestamp up to which the collection changes are known to be
+        indexed, or ``None``.
+
+        Deletions and skipped records leave no trace in the index, hence this is
+        compared to the collection timestamp instead of the indexed documents.
+        """
+        return cache.get(self._indexed_key(bucket_id, collection_id))
+
+    def invalidate_indexed(self, cache, bucket_id, collection_id):
+        cache.delete(self._indexed_key(bucket_id, collection_id))
+
+    def mark_caught_up(self, cache, timestamp):
+        """Remember that every change before ``timestamp`` was indexed by
+        ``kinto-elasticsearch-daemon``."""
+        cache.set(self._caught_up_key(), timestamp, INDEXED_TTL)
+
+    def caught_up(self, cache):
+        """Return the timestamp of the latest pass of the daemon that indexed every
+        change, or ``None``."""
+        return cache.get(self._caught_up_key())
+
+    def _caught_up_key(self):
+        return "elasticsearch:{}:caught-up".format(self.prefix)
+
+    def _indexed_key(self, bucket_id, collection_id):
+        return "elasticsearch:{}:{}:{}:indexed".format(self.prefix, bucket_id, collection_id)
+
+    def _dirty_key(self):
+        return "elasticsearch:{}:dirty-collections".format(self.prefix)
+
+    def _collections_version_key(self, bucket_id):
+        return "elasticsearch:{}:{}:collections-version".format(self.prefix, bucket_id)
 
     def search(self, bucket_id, collection_id, **kwargs):
         indexname = self.indexname(bucket_id, collection_id)
-        return self.client.search(index=indexname,
-                                  doc_type=indexname,
-                                  **kwargs)
+        with self.guard(), self.instrument("search", index=indexname):
+            results = self.search_client.search(index=indexname,
+                                                doc_type=indexname,
+                                                **kwargs)
+        # Compare with the ``search`` timer to see the time spent outside the cluster.
+        self.count("search.requests")
+        self.count("search.took", results.get("took", 0))
+        return _without_hashes(results)
+
+    def facets(self, storage, cache, bucket_id, collection_id, metadata):
+        """Return the results of the facets aggregations defined in the collection
+        metadata (``index:facets``).
+
+        Results are kept in the cache backend until the records change (see
+        :meth:`invalidate_facets`) or the collection changes. They are only cached
+        once the index has caught up with the latest change of the collection
+        (see :meth:`indexed_timestamp`).
+        """
+        definitions = metadata["index:facets"]
+        # The collection timestamp also changes when it is deleted and recreated.
+        version = metadata["last_modified"]
+        key = self._facets_key(bucket_id, collection_id)
+        cached = cache.get(key)
+        if cached is not None and cached["version"] == version:
+            self.count("facets.hits")
+            return cached["facets"]
+        self.count("facets.misses")
+
+        parent_id = "/buckets/%s/collections/%s" % (bucket_id, collection_id)
+        indexed = self.indexed_timestamp(cache, bucket_id, collection_id)
+        cacheable = indexed is not None and indexed >= storage.resource_timestamp(
+            resource_name="record", parent_id=parent_id)
+        if cacheable and self._refresh() is False:
+            # The indexed changes may not be searchable yet.
+            indexname = self.indexname(bucket_id, collection_id)
+            self.count("indices.refresh")
+            with self.guard(), self.instrument("indices.refresh", index=indexname):
+                self.client.indices.refresh(index=indexname)
+        body = {"size": 0, "aggs": definitions}
+        result = self.search(bucket_id, collection_id, body=body)
+        facets = result.get("aggregations", {})
+        # Read after the search: a change in between leaves the results uncached.
+        timestamp = storage.resource_timestamp(resource_name="record", parent_id=parent_id)
+        if cacheable and indexed >= timestamp:
+            cache.set(key, {"version": version, "facets": facets}, self.facets_ttl)
+        return facets
+
+    def invalidate_facets(self, cache, bucket_id, collection_id):
+        cache.delete(self._facets_key(bucket_id, collection_id))
+
+    def _facets_key(self, bucket_id, collection_id):
+        return "elasticsearch:{}:{}:{}:facets".format(self.prefix, bucket_id, collection_id)
+
+    def suggest(self, cache, bucket_id, collection_id, fields, prefix, size=5):
+        """Return the completion suggestions of the fields for the prefix.
+
+        Results are kept in the cache backend for a few seconds (``suggest_ttl``),
+        since the same prefixes are typed by many users.
+        """
+        key = self._suggest_key(bucket_id, collection_id, fields, prefix, size)
+        cached = cache.get(key)
+        if cached is not None:
+            self.count("suggest.hits")
+            return cached
+        self.count("suggest.misses")
+
+        suggest = {field: {"prefix": prefix,
+                           "completion": {"field": field, "size": size,
+                                          "skip_duplicates": True}}
+                   for field in fields}
+        body = {"size": 0, "_source": False, "suggest": suggest}
+        result = self.search(bucket_id, collection_id, body=body)
+        suggestions = result.get("suggest", {})
+        cache.set(key, suggestions, self.suggest_ttl)
+        return suggestions
+
+    def _suggest_key(self, bucket_id, collection_id, fields, prefix, size):
+        # Prefixes are typed by users: keep keys short and free of special characters.
+        serialized = json.dumps([sorted(fields), prefix, size])
+        digest = hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+        return "elasticsearch:{}:{}:{}:suggest:{}".format(
+            self.prefix, bucket_id, collection_id, digest)
+
+    def search_template(self, bucket_id, collection_id, name, params):
+        """Run the search template stored for the collection with the specified params."""
+        indexname = self.indexname(bucket_id, collection_id)
+        body = {"id": self.templatename(bucket_id, collection_id, name), "params": params}
+        with self.guard(), self.instrument("search_template", index=indexname):
+            results = self.search_client.search_template(index=indexname,
+                                                         doc_type=indexname,
+                                                         body=body)
+        self.count("search.requests")
+        self.count("search.took", results.get("took", 0))
+        return _without_hashes(results)
+
+    def update_templates(self, bucket_id, collection_id, templates, previous=None):
+        """Store the search templates (``{name: source}``) of the collection that changed,
+        and delete those that are not in ``templates`` anymore.
+        """
+        try:
+            self._update_templates(bucket_id, collection_id, templates, previous or {})
+        finally:
+            self._mirror("update_templates", bucket_id, collection_id, templates, previous)
+
+    def _update_templates(self, bucket_id, collection_id, templates, previous):
+        for name, source in templates.items():
+            if previous.get(name) == source:
+                continue
+            if not isinstance(source, str):
+                source = json.dumps(source)
+            script_id = self.templatename(bucket_id, collection_id, name)
+            self.count("scripts.put")
+            with self.guard(), self.instrument("put_script", id=script_id):
+                self.client.put_script(id=script_id,
+                                       body={"script": {"lang": "mustache", "source": source}})
+        for name in previous:
+            if name in templates:
+                continue
+            script_id = self.templatename(bucket_id, collection_id, name)
+            self.count("scripts.delete")
+            with self.guard(), self.instrument("delete_script", id=script_id):
+                self.client.delete_script(id=script_id, ignore=404)
+
+    def templatename(self, bucket_id, collection_id, name):
+        # Dots are not allowed in buckets and collections ids.
+        return "{}.{}".format(self.indexname(bucket_id, collection_id), name)
+
+    def projection(self, bucket_id, collection_id, schema=None):
+        """Return the tree of fields to index for this collection.
+
+        The fields are compiled once per collection schema, and ``None`` is returned
+        if the schema does not declare any property (ie. every field is indexed).
+        """
+        indexname = self.indexname(bucket_id, collection_id)
+        cached = self._projections.get(indexname)
+        if cached is None or cached[0] != schema:
+            fields = schema_fields(schema)
+            if fields is not None:
+                fields.setdefault("id", None)
+                fields.setdefault("last_modified", None)
+            cached = (schema, fields)
+            self._projections[indexname] = cached
+        return cached[1]
+
+    def record_hash(self, bucket_id, collection_id, record, schema=None):
+        """Return a stable hash of the record fields covered by the index schema.
+
+        The ``last_modified`` field is left out, so that touching only metadata or
+        fields that are not mapped does not change the hash.
+        """
+        content = project(record, self.projection(bucket_id, collection_id, schema))
+        content = {k: v for k, v in content.items() if k != "last_modified"}
+        serialized = json.dumps(content, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+    def get_hashes(self, bucket_id, collection_id, record_ids):
+        """Return the hashes stored in the index for the specified records."""
+        indexname = self.indexname(bucket_id, collection_id)
+        try:
+            with self.guard(), self.instrument("mget", index=indexname):
+                result = self.client.mget(index=indexname,
+                                          body={"ids": list(record_ids)},
+                                          _source_includes=[HASH_FIELD])
+        except elasticsearch.exceptions.NotFoundError:
+            return {}
+        return {doc["_id"]: doc["_source"].get(HASH_FIELD)
+                for doc in result["docs"] if doc.get("found")}
 
     def flush(self):
-        self.client.indices.delete(index="{}-*".format(self.prefix))
+        try:
+            indexnames = self._resolve_indices(["{}-*".format(self.prefix)])
+            self._delete_indices(indexnames)
+            self._delete_scripts(("{}-".format(self.prefix),))
+        finally:
+            self._mirror("flush")
 
     @contextmanager
     def bulk(self):
         bulk = BulkClient(self)
-        yield bulk
-        elasticsearch.helpers.bulk(self.client,
-                                   bulk.operations,
-                                   refresh=self.force_refresh)
+        with self.instrument("bulk.build"):
+            yield bulk
+        self.send(bulk.operations)
+
+    def send(self, operations):
+        """Send the operations in chunks whose size follows the cluster feedback.
+
+        Operations can be any iterable, like a generator: they are consumed one chunk
+        at a time, and each chunk is copied to the dual-write clusters once sent.
+
+        :returns: the number of operations sent.
+        :rtype: int
+        """
+        import elasticsearch.helpers  # Only needed by writers.
+
+        operations = iter(operations)
+        # Operations consumed but not sent yet.
+        pending = []
+        sent = 0
+        retries = 0
+        while "not gone through all operations":
+            chunk_size = self.sizer.chunk_size
+            if len(pending) < chunk_size:
+                pending.extend(itertools.islice(operations, chunk_size - len(pending)))
+            if not pending:
+                return sent
+            with self.instrument("bulk.serialize"):
+                # Cut by size here, so that the helpers send the chunk in a single request.
+                chunk, size = self._serialize(pending[:chunk_size], self.max_chunk_bytes)
+            started = time.time()
+            retrying = False
+            try:
+                with self.guard(), self.instrument("bulk.send", items=len(chunk), bytes=size):
+                    elasticsearch.helpers.bulk(self.client,
+                                               chunk,
+                                               chunk_size=chunk_size,
+                                               max_chunk_bytes=self.max_chunk_bytes,
+                                               refresh=self._refresh())
+            except elasticsearch.helpers.BulkIndexError as e:
+                self.count("bulk.failures", len(e.errors))
+                statuses = [item.get("status") for error in e.errors
+                            for item in error.values()]
+                if any(status in REJECTION_STATUSES for status in statuses):
+                    self.sizer.rejected()
+                raise
+            except elasticsearch.TransportError as e:
+                self.count("bulk.errors")
+                if e.status_code not in REJECTION_STATUSES or retries >= self.max_retries:
+                    raise
+                self.count("bulk.rejections")
+                # Nothing was applied, since the chunk was sent in a single request:
+                # retry the same operations with smaller chunks, once the cluster had
+                # some time to drain its queues.
+                delay = min(self.retry_backoff * 2 ** retries, MAX_RETRY_BACKOFF)
+                logger.warning("Bulk request rejected (%s), retry with smaller chunks in %ss",
+                               e.status_code, delay)
+                self.sizer.rejected()
+                retries += 1
+                retrying = True
+                time.sleep(delay)
+                continue
+            finally:
+                if not retrying:
+                    self._mirror("send", chunk)
+            self.sizer.succeeded(time.time() - started)
+            # Retries are allowed per chunk.
+            retries = 0
+            del pending[:len(chunk)]
+            sent += len(chunk)
+            # Averages per bulk are obtained by dividing with ``bulk.requests``.
+            self.count("bulk.requests")
+            self.count("bulk.items", len(chunk))
+            self.count("bulk.bytes", size)
+
+    def _refresh(self):
+        if self.force_refresh:
+            return True
+        # So that the changes are searchable once marked as indexed.
+        return "wait_for" if self.records_listing else False
+
+    def _serialize(self, operations, max_bytes=None):
+        """Return the first operations whose bulk request fits in ``max_bytes`` (at
+        least one), with serialized sources, and the total size of their sources.
+
+        The bulk helpers leave strings untouched, so documents are serialized once.
+        Requests are measured like the helpers do, which then never split the chunk.
+        """
+        import elasticsearch.helpers  # Only needed by writers.
+
+        serializer = self.client.transport.serializer
+        serialized = []
+        size = 0
+        request_size = 0
+        for operation in operations:
+            source = operation.get("_source")
+            source_size = 0
+            if source is not None:
+                source = serializer.dumps(source)
+                operation = dict(operation, _source=source)
+                source_size = len(source.encode("utf-8"))
+            if max_bytes is not None:
+                action, data = elasticsearch.helpers.expand_action(operation)
+                # Action and source lines, with their trailing new lines.
+                operation_size = len(serializer.dumps(action).encode("utf-8")) + 1
+                if data is not None:
+                    if source is None:
+                        source_size = len(serializer.dumps(data).encode("utf-8"))
+                    operation_size += source_size + 1
+                if serialized and request_size + operation_size > max_bytes:
+                    break
+                request_size += operation_size
+            size += source_size
+            serialized.append(operation)
+        return serialized, size
 
 
 class BulkClient:
+    """Gather the operations of a :meth:`Indexer.bulk` block.
+
+    Full chunks are sent while operations are added, so that large batches are not
+    held in memory: :attr:`operations` only keeps those that were not sent yet.
+    """
     def __init__(self, indexer):
         self.indexer = indexer
         self.operations = []
+        self.total = 0
+
+    def __len__(self):
+        """Return the number of operations added to the block."""
+        return self.total
+
+    def _add(self, operation):
+        self.operations.append(operation)
+        self.total += 1
+        if len(self.operations) >= self.indexer.sizer.chunk_size:
+            self.indexer.send(self.operations)
+            self.operations = []
 
-    def index_record(self, bucket_id, collection_id, record, id_field="id"):
+    def index_record(self, bucket_id, collection_id, record, id_field="id",
+                     schema=None, previous_hash=None):
         indexname = self.indexer.indexname(bucket_id, collection_id)
         record_id = record[id_field]
-        self.operations.append({
+        source = record
+        if self.indexer.schema_fields_only:
+            fields = self.indexer.projection(bucket_id, collection_id, schema)
+            source = project(record, fields)
+        if self.indexer.skip_unchanged:
+            content_hash = self.indexer.record_hash(bucket_id, collection_id, record, schema)
+            if content_hash == previous_hash:
+                # Indexed content would be the same.
+                if self.indexer.records_listing and "last_modified" in record:
+                    self._add({
+                        '_op_type': 'update',
+                        '_index': indexname,
+                        '_type': indexname,
+                        '_id': record_id,
+                        'doc': {"last_modified": record["last_modified"]},
+                    })
+                return
+            source = dict(source, **{HASH_FIELD: content_hash})
+        self._add({
             '_op_type': 'index',
             '_index': indexname,
             '_type': indexname,
             '_id': record_id,
-            '_source': record,
+            '_source': source,
         })
 
     def unindex_record(self, bucket_id, collection_id, record, id_field="id"):
         indexname = self.indexer.indexname(bucket_id, collection_id)
         record_id = record[id_field]
-        self.operations.append({
+        self._add({
             '_op_type': 'delete',
             '_index': indexname,
             '_type': indexname,
@@ -92,6 +854,166 @@ class BulkClient:
         })
 
 
+def _without_hashes(results):
+    """Remove the content hashes from the hits sources.
+
+    Removed from the results rather than with ``_source_excludes``, which would
+    override the source filtering of the query.
+    """
+    for hit in results.get("hits", {}).get("hits", []):
+        source = hit.get("_source")
+        if source is not None:
+            source.pop(HASH_FIELD, None)
+    return results
+
+
+def _join_indices(indexnames, max_length=MAX_INDICES_LENGTH):
+    """Join the index names into comma separated lists of bounded length."""
+    chunk = []
+    length = 0
+    for indexname in indexnames:
+        if chunk and length + len(indexname) + 1 > max_length:
+            yield ",".join(chunk)
+            chunk = []
+            length = 0
+        chunk.append(indexname)
+        length += len(indexname) + 1
+    if chunk:
+        yield ",".join(chunk)
+
+
+def schema_fields(schema):
+    """Return the tree of fields declared in the index schema.
+
+    :returns: a ``dict`` of sub-fields (or ``None`` for leaves), or ``None`` if the
+        schema does not declare any property.
+    """
+    if not schema or "properties" not in schema:
+        return None
+    return {name: schema_fields(definition)
+            for name, definition in schema["properties"].items()}
+
+
+def completion_fields(schema, prefix=""):
+    """Return the names of the fields mapped as ``completion`` in the index schema."""
+    names = []
+    for name, definition in ((schema or {}).get("properties") or {}).items():
+        if definition.get("type") == "completion":
+            names.append(prefix + name)
+        names.extend(completion_fields(definition, prefix=prefix + name + "."))
+    return names
+
+
+def project(record, fields):
+    """Return a copy of the record restricted to the specified tree of fields."""
+    if fields is None:
+        return record
+    if isinstance(record, list):
+        return [project(item, fields) for item in record]
+    if not isinstance(record, dict):
+        return record
+    return {name: project(record[name], subfields)
+            for name, subfields in fields.items() if name in record}
+
+
+def get_index_schema(storage, bucket_id, collection_id):
+    # Open collection metadata.
+    # XXX: https://github.com/Kinto/kinto/issues/710
+    metadata = storage.get(resource_name="collection",
+                           parent_id="/buckets/%s" % bucket_id,
+                           object_id=collection_id)
+    return metadata.get("index:schema")
+
+
+class Throttle(object):
+    """Enforce a minimum interval between the requests of each user.
+
+    Intervals are tracked in process, for the most recent users only.
+    """
+    def __init__(self, min_interval=0.1, max_users=10000):
+        self.min_interval = min_interval
+        self.max_users = max_users
+        self._latest = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def wait(self, user_id):
+        """Return the seconds to wait before the user can send a request, or ``0``
+        if the request is allowed.
+        """
+        now = time.time()
+        with self._lock:
+            latest = self._latest.get(user_id)
+            if latest is not None and now - latest < self.min_interval:
+                return self.min_interval - (now - latest)
+            self._latest[user_id] = now
+            self._latest.move_to_end(user_id)
+            if len(self._latest) > self.max_users:
+                self._latest.popitem(last=False)
+        return 0
+
+
+class HealthCheck(object):
+    """Check the cluster health and the rejections of the bulk thread pools.
+
+    If ``max_lag`` is specified, also check that ``kinto-elasticsearch-daemon``
+    indexed every change less than ``max_lag`` seconds ago.
+
+    The result is kept for ``cache_ttl`` seconds, so that frequent heartbeats
+    do not hammer the cluster.
+    """
+    def __init__(self, indexer, min_status="yellow", max_rejections=None, cache_ttl=5,
+                 max_lag=None, cache=None):
+        if min_status not in HEALTH_STATUSES:
+            raise ConfigurationError("Unknown cluster health status '{}'".format(min_status))
+        self.indexer = indexer
+        self.min_status = min_status
+        self.max_rejections = max_rejections
+        self.cache_ttl = cache_ttl
+        self.max_lag = max_lag
+        self.cache = cache
+        self._result = None
+        self._expires = 0
+        self._rejected = None
+
+    def __call__(self):
+        now = time.time()
+        if self._result is None or now >= self._expires:
+            self._result = self._check()
+            self._expires = now + self.cache_ttl
+        return self._result
+
+    def _check(self):
+        client = self.indexer.client
+        with self.indexer.instrument("cluster.health"):
+            status = client.cluster.health()["status"]
+        if HEALTH_STATUSES.index(status) < HEALTH_STATUSES.index(self.min_status):
+            logger.warning("ElasticSearch cluster health is %s", status)
+            return False
+
+        if self.max_lag is not None:
+            caught_up = self.indexer.caught_up(self.cache)
+            if caught_up is None or (msec_time() - caught_up) / 1000 > self.max_lag:
+                logger.warning("Indexing daemon has not caught up for %ss", self.max_lag)
+                return False
+
+        if self.max_rejections is None:
+            return True
+        with self.indexer.instrument("nodes.stats"):
+            stats = client.nodes.stats(metric="thread_pool")
+        rejected = 0
+        for node in stats["nodes"].values():
+            pools = node["thread_pool"]
+            # The ``bulk`` pool was renamed ``write`` in ElasticSearch 6.3.
+            pool = pools.get("write", pools.get("bulk", {}))
+            rejected += pool.get("rejected", 0)
+        # Counters are cumulative since the nodes started: compare with the last check.
+        previous, self._rejected = self._rejected, rejected
+        if previous is not None and rejected - previous > self.max_rejections:
+            logger.warning("ElasticSearch rejected %s bulk requests", rejected - previous)
+            return False
+        return True
+
+
 def heartbeat(request):
     """Test that ElasticSearch is operationnal.
 
@@ -102,7 +1024,13 @@ def heartbeat(request):
     """
     indexer = request.registry.indexer
     try:
-        return indexer.client.ping()
+        if not indexer.client.ping():
+            return False
+        if indexer.search_client is not indexer.client and not indexer.search_client.ping():
+            return False
+        if indexer.health_check is not None:
+            return indexer.health_check()
+        return True
     except Exception as e:
         logger.exception(e)
         return False
@@ -111,7 +1039,85 @@ def heartbeat(request):
 def load_from_config(config):
     settings = config.get_settings()
     hosts = aslist(settings.get('elasticsearch.hosts', 'localhost:9200'))
+    search_hosts = aslist(settings.get('elasticsearch.search_hosts', ''))
+    # One cluster per line, hosts separated with commas.
+    dual_write_hosts = [[host.strip() for host in line.split(",") if host.strip()]
+                        for line in aslist(settings.get('elasticsearch.dual_write_hosts', ''),
+                                           flatten=False)]
     prefix = settings.get('elasticsearch.index_prefix', 'kinto')
     force_refresh = asbool(settings.get('elasticsearch.force_refresh', 'false'))
-    indexer = Indexer(hosts=hosts, prefix=prefix, force_refresh=force_refresh)
+    sizing = dict(
+        initial=int(settings.get('elasticsearch.bulk.initial_chunk_size', 500)),
+        minimum=int(settings.get('elasticsearch.bulk.min_chunk_size', 10)),
+        maximum=int(settings.get('elasticsearch.bulk.max_chunk_size', 5000)),
+        increment=int(settings.get('elasticsearch.bulk.chunk_size_increment', 50)),
+        target_duration=float(settings.get('elasticsearch.bulk.target_duration', 1.0)))
+    max_chunk_bytes = int(settings.get('elasticsearch.bulk.max_chunk_bytes', 10 * 1024 * 1024))
+    max_retries = int(settings.get('elasticsearch.bulk.max_retries', 3))
+    retry_backoff = float(settings.get('elasticsearch.bulk.retry_backoff', 1.0))
+    skip_unchanged = asbool(settings.get('elasticsearch.skip_unchanged', 'false'))
+    records_listing = asbool(settings.get('elasticsearch.records_listing', 'false'))
+    schema_fields_only = asbool(settings.get('elasticsearch.index_schema_fields_only', 'false'))
+    metadata_ttl = int(settings.get('elasticsearch.metadata_cache_ttl', 300))
+    slow_call_duration = settings.get('elasticsearch.circuit_breaker.slow_call_duration')
+    breaker_settings = dict(
+        failure_rate=float(settings.get('elasticsearch.circuit_breaker.failure_rate', 0.5)),
+        window=int(settings.get('elasticsearch.circuit_breaker.window', 20)),
+        slow_call_duration=float(slow_call_duration) if slow_call_duration else None,
+        reset_timeout=float(settings.get('elasticsearch.circuit_breaker.reset_timeout', 30)))
+    circuit_breaker = None
+    if asbool(settings.get('elasticsearch.circuit_breaker.enabled', 'false')):
+        circuit_breaker = CircuitBreaker(**breaker_settings)
+    dirty_ttl = int(settings.get('elasticsearch.dirty_collections_ttl', 7 * 24 * 3600))
+    facets_ttl = int(settings.get('elasticsearch.facets_cache_ttl', 3600))
+    suggest_ttl = int(settings.get('elasticsearch.suggest_cache_ttl', 10))
+    tracer = None
+    if asbool(settings.get('elasticsearch.tracing', 'false')):
+        # Only imported when enabled, since it is slow to import.
+        try:
+            from opentelemetry import trace
+        except ImportError:  # pragma: no cover
+            error_msg = "Please install the opentelemetry-api package to enable tracing"
+            raise ConfigurationError(error_msg)
+        tracer = trace.get_tracer(__name__)
+    # Each cluster adapts its own bulk sizes, and has its own circuit breaker, since
+    # the dual-write clusters are called synchronously.
+    dual_write_timeout = float(settings.get('elasticsearch.dual_write_timeout', 5))
+    mirrors = [Indexer(hosts=mirror_hosts, prefix=prefix, force_refresh=force_refresh,
+                       max_chunk_bytes=max_chunk_bytes, max_retries=max_retries,
+                       retry_backoff=retry_backoff,
+                       sizer=BulkSizer(**sizing), skip_unchanged=skip_unchanged,
+                       schema_fields_only=schema_fields_only,
+                       tracer=tracer,
+                       circuit_breaker=CircuitBreaker(**breaker_settings),
+                       timeout=dual_write_timeout)
+               for mirror_hosts in dual_write_hosts]
+    indexer = Indexer(hosts=hosts, prefix=prefix, force_refresh=force_refresh,
+                      max_chunk_bytes=max_chunk_bytes, max_retries=max_retries,
+                      retry_backoff=retry_backoff,
+                      sizer=BulkSizer(**sizing), skip_unchanged=skip_unchanged,
+                      schema_fields_only=schema_fields_only,
+                      metadata_ttl=metadata_ttl,
+                      statsd=config.registry.statsd,
+                      tracer=tracer,
+                      circuit_breaker=circuit_breaker,
+                      dirty_ttl=dirty_ttl,
+                      search_hosts=search_hosts,
+                      mirrors=mirrors,
+                      facets_ttl=facets_ttl,
+                      suggest_ttl=suggest_ttl,
+                      records_listing=records_listing)
+    suggest_min_interval = float(settings.get('elasticsearch.suggest_min_interval', 0.1))
+    if suggest_min_interval > 0:
+        indexer.suggest_throttle = Throttle(min_interval=suggest_min_interval)
+    if asbool(settings.get('elasticsearch.heartbeat.check_health', 'false')):
+        max_rejections = settings.get('elasticsearch.heartbeat.max_rejections')
+        max_lag = settings.get('elasticsearch.heartbeat.max_indexing_lag')
+        indexer.health_check = HealthCheck(
+            indexer,
+            min_status=settings.get('elasticsearch.heartbeat.min_status', 'yellow'),
+            max_rejections=int(max_rejections) if max_rejections else None,
+            cache_ttl=float(settings.get('elasticsearch.heartbeat.cache_ttl', 5)),
+            max_lag=float(max_lag) if max_lag else None,
+            cache=config.registry.cache if max_lag else None)
     return indexer
@@ -2,6 +2,11 @@ import logging
 
 import elasticsearch
 from kinto.core.events import ACTIONS
+from kinto.core.storage import Filter, Sort
+from kinto.core.storage import exceptions as storage_exceptions
+from kinto.core.utils import COMPARISON
+
+from .indexer import CircuitOpenError
 
 
 logger = logging.getLogger(__name__)
@@ -10,15 +15,20 @@ logger = logging.getLogger(__name__)
 def on_collection_created(event):
     indexer = event.request.registry.indexer
     bucket_id = event.payload["bucket_id"]
+    indexer.invalidate_collections(event.request.registry.cache, bucket_id)
     for created in event.impacted_records:
         collection_id = created["new"]["id"]
         schema = created["new"].get("index:schema")
         indexer.create_index(bucket_id, collection_id, schema=schema)
+        templates = created["new"].get("index:templates")
+        if templates:
+            indexer.update_templates(bucket_id, collection_id, templates)
 
 
 def on_collection_updated(event):
     indexer = event.request.registry.indexer
     bucket_id = event.payload["bucket_id"]
+    indexer.invalidate_collections(event.request.registry.cache, bucket_id)
     for updated in event.impacted_records:
         collection_id = updated["new"]["id"]
         old_schema = updated["old"].get("index:schema")
@@ -29,20 +39,79 @@ def on_collection_updated(event):
         elif old_schema != new_schema:
             indexer.update_index(bucket_id, collection_id, schema=new_schema)
 
+        old_templates = updated["old"].get("index:templates") or {}
+        new_templates = updated["new"].get("index:templates") or {}
+        if old_templates != new_templates:
+            indexer.update_templates(bucket_id, collection_id, new_templates,
+                                     previous=old_templates)
+
 
 def on_collection_deleted(event):
     indexer = event.request.registry.indexer
     bucket_id = event.payload["bucket_id"]
+    indexer.invalidate_collections(event.request.registry.cache, bucket_id)
+    collections = [(bucket_id, deleted["old"]["id"]) for deleted in event.impacted_records]
+    for _, collection_id in collections:
+        indexer.invalidate_indexed(event.request.registry.cache, bucket_id, collection_id)
+    indexer.delete_indices(collections=collections)
     for deleted in event.impacted_records:
-        collection_id = deleted["old"]["id"]
-        indexer.delete_index(bucket_id, collection_id)
+        templates = deleted["old"].get("index:templates")
+        if templates:
+            indexer.update_templates(bucket_id, deleted["old"]["id"], {}, previous=templates)
 
 
 def on_bucket_deleted(event):
     indexer = event.request.registry.indexer
-    for deleted in event.impacted_records:
-        bucket_id = deleted["old"]["id"]
-        indexer.delete_index(bucket_id)
+    bucket_ids = [deleted["old"]["id"] for deleted in event.impacted_records]
+    for bucket_id in bucket_ids:
+        indexer.invalidate_collections(event.request.registry.cache, bucket_id)
+    # The indices of bucket ``a-b`` also match the indices names of bucket ``a``.
+    try:
+        siblings = _prefixed_collections(event.request.registry.storage, bucket_ids)
+    except storage_exceptions.BackendError:
+        # Without the complete list of indices to keep, nothing is deleted.
+        logger.exception("Failed to list the collections of the buckets prefixed with %s, "
+                         "their indices are kept", ", ".join(bucket_ids))
+        return
+    keep = set(indexer.indexname(bucket_id, collection_id)
+               for bucket_id, collection_id in siblings)
+    indexer.delete_indices(bucket_ids=bucket_ids, keep=keep)
+
+
+def _prefixed_collections(storage, bucket_ids):
+    """Return the ``(bucket_id, collection_id)`` of the collections of the buckets
+    whose id starts with one of ``bucket_ids`` followed by ``-``."""
+    collections = []
+    for bucket_id in bucket_ids:
+        prefix = "%s-" % bucket_id
+        # Case insensitive (and ``_`` matches any character with PostgreSQL).
+        like = Filter("id", "%s*" % prefix, COMPARISON.LIKE)
+        for bucket in _list_by_id(storage, "bucket", "", filters=[like]):
+            if not bucket["id"].startswith(prefix):
+                continue
+            records = _list_by_id(storage, "collection", "/buckets/%s" % bucket["id"])
+            collections.extend((bucket["id"], record["id"]) for record in records)
+    return collections
+
+
+def _list_by_id(storage, resource_name, parent_id, filters=None, limit=1000):
+    """Yield every object of the parent, by ascending id.
+
+    The backends return at most ``storage_max_fetch_size`` objects per call, so the
+    pages are read until an empty one.
+    """
+    pagination_rules = []
+    while "not gone through all pages":
+        objects = storage.list_all(resource_name=resource_name,
+                                   parent_id=parent_id,
+                                   filters=filters,
+                                   sorting=[Sort("id", 1)],
+                                   pagination_rules=pagination_rules,
+                                   limit=limit)
+        if not objects:
+            break  # Done.
+        yield from objects
+        pagination_rules = [[Filter("id", objects[-1]["id"], COMPARISON.GT)]]
 
 
 def on_record_changed(event):
@@ -52,6 +121,17 @@ def on_record_changed(event):
     collection_id = event.payload["collection_id"]
     action = event.payload["action"]
 
+    indexer.invalidate_facets(event.request.registry.cache, bucket_id, collection_id)
+
+    schema = None
+    compare_hashes = indexer.skip_unchanged and action == ACTIONS.UPDATE.value
+    if compare_hashes or (indexer.schema_fields_only and action != ACTIONS.DELETE.value):
+        registry = event.request.registry
+        metadata = indexer.get_collection(registry.storage, registry.cache,
+                                          bucket_id, collection_id)
+        if metadata is not None:
+            schema = metadata.get("index:schema")
+
     try:
         with indexer.bulk() as bulk:
             for change in event.impacted_records:
@@ -60,11 +140,36 @@ def on_record_changed(event):
                                         collection_id,
                                         record=change["old"])
                 else:
+                    previous_hash = None
+                    if compare_hashes:
+                        previous_hash = indexer.record_hash(bucket_id,
+                                                            collection_id,
+                                                            change["old"],
+                                                            schema)
                     bulk.index_record(bucket_id,
                                       collection_id,
-                                      record=change["new"])
+                                      record=change["new"],
+                                      schema=schema,
+                                      previous_hash=previous_hash)
+    except CircuitOpenError:
+        logger.warning("ElasticSearch is unavailable, %s/%s marked as dirty",
+                       bucket_id, collection_id)
+        indexer.mark_dirty(event.request.registry.cache, bucket_id, collection_id)
     except elasticsearch.ElasticsearchException:
         logger.exception("Failed to index record")
+        indexer.mark_dirty(event.request.registry.cache, bucket_id, collection_id)
+    else:
+        # Changes merged in the same event (eg. batch) keep the first timestamp.
+        timestamp = max([event.payload["timestamp"]] +
+                        [change["new"]["last_modified"] for change in event.impacted_records])
+        indexer.mark_indexed(event.request.registry.cache, bucket_id, collection_id, timestamp)
+
+
+def on_record_changed_elsewhere(event):
+    indexer = event.request.registry.indexer
+    bucket_id = event.payload["bucket_id"]
+    collection_id = event.payload["collection_id"]
+    indexer.invalidate_facets(event.request.registry.cache, bucket_id, collection_id)
 
 
 def on_server_flushed(event):
@@ -0,0 +1,195 @@
+import logging
+import re
+
+import elasticsearch
+from kinto.core.storage import Filter
+from kinto.core.utils import COMPARISON
+from pyramid.threadlocal import get_current_request
+
+
+logger = logging.getLogger(__name__)
+
+# Field types whose values are compared like in the storage.
+COMPARABLE_TYPES = ("keyword", "boolean", "long", "integer", "short", "byte",
+                    "double", "float", "half_float", "scaled_float")
+
+RECORDS_PARENT = re.compile(r"^/buckets/([^/]+)/collections/([^/]+)$")
+
+
+class UnsupportedQuery(Exception):
+    """Raised when the filters or the sorting cannot be translated."""
+
+
+class SearchStorage(object):
+    """Serve the records plural endpoint from the index.
+
+    The storage backend is wrapped, so that Kinto keeps handling the querystring,
+    the permissions and the pagination. When the listing filters or sorts on
+    indexed fields, the ids of the matching records are obtained from the index,
+    and the records are then fetched from the storage by id.
+
+    The storage is used as usual if the query cannot be translated, if the
+    index is not known to be up to date with the collection (see
+    :meth:`Indexer.indexed_timestamp`), or if the cluster fails.
+    """
+    def __init__(self, storage, indexer):
+        self.storage = storage
+        self.indexer = indexer
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def list_all(self, resource_name, parent_id, filters=None, sorting=None,
+                 pagination_rules=None, limit=None, include_deleted=False, id_field="id",
+                 modified_field="last_modified", deleted_field="deleted"):
+        kwargs = dict(resource_name=resource_name, parent_id=parent_id, filters=filters,
+                      sorting=sorting, pagination_rules=pagination_rules, limit=limit,
+                      include_deleted=include_deleted, id_field=id_field,
+                      modified_field=modified_field, deleted_field=deleted_field)
+        request = get_current_request()
+        # Only for the records listing: scripts and other endpoints use the storage.
+        matched = RECORDS_PARENT.match(parent_id or "")
+        if (resource_name != "record" or matched is None or request is None or
+                request.matched_route is None or
+                request.matched_route.name != "record-plural" or
+                # Tombstones are not indexed.
+                include_deleted or not limit):
+            return self.storage.list_all(**kwargs)
+
+        builtins = (id_field, modified_field)
+        fields = [f.field for f in filters or []] + [s.field for s in sorting or []]
+        if all(field in builtins for field in fields):
+            # Nothing the storage cannot do efficiently.
+            return self.storage.list_all(**kwargs)
+
+        try:
+            records = self._list_from_index(request, **kwargs)
+        except UnsupportedQuery as e:
+            logger.debug("Records listing not served from index: %s", e)
+            records = None
+        except elasticsearch.ElasticsearchException:
+            logger.exception("Failed to list records from index")
+            records = None
+        if records is None:
+            self.indexer.count("listing.fallbacks")
+            return self.storage.list_all(**kwargs)
+        self.indexer.count("listing.hits")
+        return records
+
+    def _list_from_index(self, request, resource_name, parent_id, filters, sorting,
+                         pagination_rules, limit, include_deleted, id_field, modified_field,
+                         deleted_field):
+        bucket_id, collection_id = RECORDS_PARENT.match(parent_id).groups()
+        indexed = self.indexer.indexed_timestamp(request.registry.cache,
+                                                 bucket_id, collection_id)
+        timestamp = self.storage.resource_timestamp(resource_name=resource_name,
+                                                    parent_id=parent_id)
+        if indexed is None or indexed < timestamp:
+            raise UnsupportedQuery("index is not up to date")
+
+        metadata = self.indexer.get_collection(self.storage, request.registry.cache,
+                                               bucket_id, collection_id)
+        schema = (metadata or {}).get("index:schema")
+        types = FieldTypes(schema, id_field, modified_field)
+
+        body = {
+            "query": build_query(filters, pagination_rules, types),
+            "sort": build_sort(sorting, types),
+            "size": limit,
+            "_source": False,
+        }
+        result = self.indexer.search(bucket_id, collection_id, body=body)
+
+        ids = [hit["_id"] for hit in result["hits"]["hits"]]
+        if not ids:
+            return []
+        records = self.storage.list_all(resource_name=resource_name,
+                                        parent_id=parent_id,
+                                        filters=[Filter(id_field, ids, COMPARISON.IN)],
+                                        id_field=id_field,
+                                        modified_field=modified_field,
+                                        deleted_field=deleted_field)
+        # Keep the order of the index.
+        by_id = {record[id_field]: record for record in records}
+        return [by_id[record_id] for record_id in ids if record_id in by_id]
+
+
+class FieldTypes(object):
+    """Resolve the indexed name and type of the records fields."""
+    def __init__(self, schema, id_field="id", modified_field="last_modified"):
+        self.schema = schema or {}
+        self.id_field = id_field
+        self.modified_field = modified_field
+
+    def __call__(self, field):
+        """Return the ``(name, type)`` of the field in the index."""
+        if field == self.id_field:
+            # Always indexed, whatever the mapping of the ``id`` field.
+            return "_id", "_id"
+        if field == self.modified_field:
+            return field, "long"
+        definition = self.schema
+        for name in field.split("."):
+            definition = definition.get("properties", {}).get(name, {})
+        field_type = definition.get("type")
+        if field_type not in COMPARABLE_TYPES:
+            raise UnsupportedQuery("field '{}' is not indexed as {}".format(
+                field, ", ".join(COMPARABLE_TYPES)))
+        return field, field_type
+
+
+def build_query(filters, pagination_rules, types):
+    """Translate the Kinto filters and pagination rules to an ElasticSearch query.
+
+    Filters are combined with *AND*, pagination rules with *OR*.
+    """
+    query = _conditions(filters or [], types)
+    if pagination_rules:
+        rules = [{"bool": _conditions(rule, types)} for rule in pagination_rules]
+        query.setdefault("filter", []).append({"bool": {"should": rules,
+                                                        "minimum_should_match": 1}})
+    return {"bool": query}
+
+
+def _conditions(filters, types):
+    conditions = {}
+    for filtr in filters:
+        occur, clause = _clause(filtr, *types(filtr.field))
+        conditions.setdefault(occur, []).append(clause)
+    return conditions
+
+
+def _clause(filtr, field, field_type):
+    operator, value = filtr.operator, filtr.value
+    if field_type == "_id" and operator not in (COMPARISON.EQ, COMPARISON.NOT,
+                                                COMPARISON.IN, COMPARISON.EXCLUDE):
+        raise UnsupportedQuery("the id field can only be compared for equality")
+
+    if operator == COMPARISON.EQ:
+        return "filter", {"term": {field: value}}
+    if operator == COMPARISON.NOT:
+        return "must_not", {"term": {field: value}}
+    if operator in (COMPARISON.IN, COMPARISON.CONTAINS_ANY):
+        return "filter", {"terms": {field: list(value)}}
+    if operator == COMPARISON.EXCLUDE:
+        return "must_not", {"terms": {field: list(value)}}
+    if operator == COMPARISON.CONTAINS:
+        return "filter", {"bool": {"filter": [{"term": {field: v}} for v in value]}}
+    if operator == COMPARISON.HAS:
+        return ("filter" if value else "must_not"), {"exists": {"field": field}}
+    ranges = {COMPARISON.LT: "lt", COMPARISON.GT: "gt",
+              COMPARISON.MIN: "gte", COMPARISON.MAX: "lte"}
+    if operator in ranges:
+        return "filter", {"range": {field: {ranges[operator]: value}}}
+    raise UnsupportedQuery("operator '{}' is not supported".format(operator.value))
+
+
+def build_sort(sorting, types):
+    sort = []
+    for order in sorting or []:
+        field, field_type = types(order.field)
+        if field_type == "_id":
+            raise UnsupportedQuery("cannot sort on the id field")
+        direction = "asc" if order.direction > 0 else "desc"
+        sort.append({field: {"order": direction, "unmapped_type": field_type}})
+    return sort
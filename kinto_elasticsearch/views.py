@@ -1,13 +1,15 @@
 import json
 import logging
+import math
 
 import elasticsearch
 from kinto.core import authorization
 from kinto.core import Service
-from kinto.core import utils
 from kinto.core.errors import http_error, ERRORS
 from pyramid import httpexceptions
 
+from .indexer import CircuitOpenError, completion_fields
+
 
 logger = logging.getLogger(__name__)
 
@@ -15,8 +17,9 @@ logger = logging.getLogger(__name__)
 class RouteFactory(authorization.RouteFactory):
     def __init__(self, request):
         super().__init__(request)
-        records_plural = utils.strip_uri_prefix(request.path.replace("/search", "/records"))
-        self.permission_object_id = records_plural
+        # Same permissions as the records list.
+        records_plural = "/buckets/%(bucket_id)s/collections/%(collection_id)s/records"
+        self.permission_object_id = records_plural % request.matchdict
         self.required_permission = "read"
 
 
@@ -25,17 +28,38 @@ search = Service(name="search",
                  description="Search",
                  factory=RouteFactory)
 
+search_template = Service(name="search_template",
+                          path=('/buckets/{bucket_id}/collections/{collection_id}'
+                                '/search/{template}'),
+                          description="Search with a stored template",
+                          factory=RouteFactory)
 
-def search_view(request, **kwargs):
-    bucket_id = request.matchdict['bucket_id']
-    collection_id = request.matchdict['collection_id']
+suggest = Service(name="suggest",
+                  path='/buckets/{bucket_id}/collections/{collection_id}/suggest',
+                  description="Suggest",
+                  factory=RouteFactory)
 
-    # Limit the number of results to return, based on existing Kinto settings.
+facets = Service(name="facets",
+                 path='/buckets/{bucket_id}/collections/{collection_id}/facets',
+                 description="Facets",
+                 factory=RouteFactory)
+
+
+def max_results(request):
+    """Return the number of results to return, based on existing Kinto settings."""
     paginate_by = request.registry.settings.get("paginate_by")
     max_fetch_size = request.registry.settings["storage_max_fetch_size"]
     if paginate_by is None or paginate_by <= 0:
         paginate_by = max_fetch_size
-    configured = min(paginate_by, max_fetch_size)
+    return min(paginate_by, max_fetch_size)
+
+
+def search_view(request, **kwargs):
+    bucket_id = request.matchdict['bucket_id']
+    collection_id = request.matchdict['collection_id']
+
+    # Limit the number of results to return.
+    configured = max_results(request)
     # If the size is specified in query, ignore it if larger than setting.
     specified = None
     if "body" in kwargs:
@@ -65,15 +89,26 @@ def search_view(request, **kwargs):
         else:
             message = e.info["error"]
             details = None
+        indexer.count("search.invalid_queries")
         response = http_error(httpexceptions.HTTPBadRequest(),
                               errno=ERRORS.INVALID_PARAMETERS,
                               message=message,
                               details=details)
         raise response
 
+    except CircuitOpenError as e:
+        # Fail fast while the cluster is unavailable.
+        response = http_error(httpexceptions.HTTPServiceUnavailable(),
+                              errno=ERRORS.BACKEND,
+                              message="Search is temporarily unavailable.")
+        response.headers["Retry-After"] = str(e.retry_after)
+        # Returned, since the error view would override the ``Retry-After`` header.
+        return response
+
     except elasticsearch.ElasticsearchException as e:
         # General failure.
         logger.exception(f"Index query failed ({e})")
+        indexer.count("search.failures")
         results = {}
 
     return results
@@ -89,3 +124,191 @@ def post_search(request):
 def get_search(request):
     q = request.GET.get("q")
     return search_view(request, q=q)
+
+
+def search_template_view(request, params):
+    bucket_id = request.matchdict['bucket_id']
+    collection_id = request.matchdict['collection_id']
+    name = request.matchdict['template']
+
+    indexer = request.registry.indexer
+    metadata = indexer.get_collection(request.registry.storage, request.registry.cache,
+                                      bucket_id, collection_id)
+    # Only the templates of the collection can be run.
+    templates = (metadata or {}).get("index:templates") or {}
+    if name not in templates:
+        raise http_error(httpexceptions.HTTPNotFound(),
+                         errno=ERRORS.MISSING_RESOURCE,
+                         message="Search template not found.")
+    if not isinstance(params, dict):
+        raise http_error(httpexceptions.HTTPBadRequest(),
+                         errno=ERRORS.INVALID_PARAMETERS,
+                         message="Template parameters must be an object.")
+    # The size is chosen by the template: only the results are truncated.
+    configured = max_results(request)
+    try:
+        too_large = int(params.get("size", 0)) > configured
+    except (TypeError, ValueError):
+        too_large = False
+    if too_large:
+        raise http_error(httpexceptions.HTTPBadRequest(),
+                         errno=ERRORS.INVALID_PARAMETERS,
+                         message="size cannot be larger than {}.".format(configured))
+
+    try:
+        results = indexer.search_template(bucket_id, collection_id, name, params)
+
+    except elasticsearch.NotFoundError:
+        # If the cluster was unavailable when the collection changed, or if plugin
+        # was enabled after the creation of the collection.
+        indexer.create_index(bucket_id, collection_id)
+        indexer.update_templates(bucket_id, collection_id, {name: templates[name]})
+        results = indexer.search_template(bucket_id, collection_id, name, params)
+
+    except elasticsearch.RequestError as e:
+        # Invalid template or parameters.
+        indexer.count("search.invalid_queries")
+        raise http_error(httpexceptions.HTTPBadRequest(),
+                         errno=ERRORS.INVALID_PARAMETERS,
+                         message="Invalid search template or parameters.",
+                         details=e.info["error"] if isinstance(e.info["error"], dict) else None)
+
+    except CircuitOpenError as e:
+        response = http_error(httpexceptions.HTTPServiceUnavailable(),
+                              errno=ERRORS.BACKEND,
+                              message="Search is temporarily unavailable.")
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
+
+    except elasticsearch.ElasticsearchException as e:
+        logger.exception(f"Index query failed ({e})")
+        indexer.count("search.failures")
+        results = {}
+
+    hits = results.get("hits", {}).get("hits")
+    if hits is not None and len(hits) > configured:
+        del hits[configured:]
+    return results
+
+
+@search_template.post(permission=authorization.DYNAMIC)
+def post_search_template(request):
+    try:
+        params = json.loads(request.body.decode("utf-8") or "{}")
+    except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+        params = None
+    return search_template_view(request, params)
+
+
+@search_template.get(permission=authorization.DYNAMIC)
+def get_search_template(request):
+    return search_template_view(request, dict(request.GET))
+
+
+@facets.get(permission=authorization.DYNAMIC)
+def get_facets(request):
+    bucket_id = request.matchdict['bucket_id']
+    collection_id = request.matchdict['collection_id']
+
+    indexer = request.registry.indexer
+    metadata = indexer.get_collection(request.registry.storage, request.registry.cache,
+                                      bucket_id, collection_id)
+    if metadata is None:
+        raise http_error(httpexceptions.HTTPNotFound(),
+                         errno=ERRORS.MISSING_RESOURCE,
+                         message="Collection not found.")
+    if not metadata.get("index:facets"):
+        return {}
+
+    try:
+        return indexer.facets(request.registry.storage, request.registry.cache,
+                              bucket_id, collection_id, metadata)
+
+    except elasticsearch.RequestError as e:
+        # Invalid definitions.
+        indexer.count("facets.failures")
+        raise http_error(httpexceptions.HTTPBadRequest(),
+                         errno=ERRORS.INVALID_PARAMETERS,
+                         message="Invalid `index:facets` in collection metadata.",
+                         details=e.info["error"] if isinstance(e.info["error"], dict) else None)
+
+    except CircuitOpenError as e:
+        response = http_error(httpexceptions.HTTPServiceUnavailable(),
+                              errno=ERRORS.BACKEND,
+                              message="Facets are temporarily unavailable.")
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
+
+    except elasticsearch.ElasticsearchException as e:
+        # General failure (eg. no index yet).
+        logger.exception(f"Facets query failed ({e})")
+        indexer.count("facets.failures")
+        return {}
+
+
+@suggest.get(permission=authorization.DYNAMIC)
+def get_suggest(request):
+    bucket_id = request.matchdict['bucket_id']
+    collection_id = request.matchdict['collection_id']
+
+    indexer = request.registry.indexer
+    throttle = indexer.suggest_throttle
+    if throttle is not None:
+        wait = throttle.wait(request.prefixed_userid or request.client_addr)
+        if wait > 0:
+            indexer.count("suggest.throttled")
+            response = http_error(httpexceptions.HTTPTooManyRequests(),
+                                  errno=ERRORS.CLIENT_REACHED_CAPACITY,
+                                  message="Too many suggestions requests.")
+            response.headers["Retry-After"] = str(math.ceil(wait))
+            return response
+
+    metadata = indexer.get_collection(request.registry.storage, request.registry.cache,
+                                      bucket_id, collection_id)
+    if metadata is None:
+        raise http_error(httpexceptions.HTTPNotFound(),
+                         errno=ERRORS.MISSING_RESOURCE,
+                         message="Collection not found.")
+
+    prefix = request.GET.get("q")
+    if not prefix:
+        raise http_error(httpexceptions.HTTPBadRequest(),
+                         errno=ERRORS.MISSING_PARAMETERS,
+                         message="The `q` parameter is required.")
+    fields = completion_fields(metadata.get("index:schema"))
+    if "field" in request.GET:
+        if request.GET["field"] not in fields:
+            raise http_error(httpexceptions.HTTPBadRequest(),
+                             errno=ERRORS.INVALID_PARAMETERS,
+                             message="Field is not mapped as `completion` in `index:schema`.")
+        fields = [request.GET["field"]]
+    if not fields:
+        return {}
+    try:
+        size = int(request.GET.get("size", 5))
+    except ValueError:
+        size = 0
+    # Same limit as the search results.
+    configured = max_results(request)
+    if not 0 < size <= configured:
+        raise http_error(httpexceptions.HTTPBadRequest(),
+                         errno=ERRORS.INVALID_PARAMETERS,
+                         message="The `size` parameter must be between 1 and "
+                                 "{}.".format(configured))
+
+    try:
+        return indexer.suggest(request.registry.cache, bucket_id, collection_id,
+                               fields, prefix, size=size)
+
+    except CircuitOpenError as e:
+        response = http_error(httpexceptions.HTTPServiceUnavailable(),
+                              errno=ERRORS.BACKEND,
+                              message="Suggestions are temporarily unavailable.")
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
+
+    except elasticsearch.ElasticsearchException as e:
+        # General failure (eg. no index yet).
+        logger.exception(f"Suggest query failed ({e})")
+        indexer.count("suggest.failures")
+        return {}
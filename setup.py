@@ -11,7 +11,7 @@ with open('CHANGELOG.rst') as history_file:
 
 REQUIREMENTS = [
     'elasticsearch',
-    'kinto>=6.0.0'
+    'kinto>=14.0.0'
 ]
 
 TEST_REQUIREMENTS = [
@@ -22,7 +22,9 @@ TEST_REQUIREMENTS = [
 
 ENTRY_POINTS = {
     'console_scripts': [
-        'kinto-elasticsearch-reindex = kinto_elasticsearch.command_reindex:main'
+        'kinto-elasticsearch-reindex = kinto_elasticsearch.command_reindex:main',
+        'kinto-elasticsearch-check = kinto_elasticsearch.command_check:main',
+        'kinto-elasticsearch-daemon = kinto_elasticsearch.command_daemon:main',
     ],
 }
 
@@ -2,7 +2,9 @@ import elasticsearch
 import mock
 import os
 import unittest
-from kinto_elasticsearch.command_reindex import main, reindex_records, get_paginated_records
+from kinto_elasticsearch.command_reindex import (main, reindex_records, get_paginated_records,
+                                                 get_records_pages, stream_records)
+from kinto_elasticsearch import command_check, command_daemon
 from . import BaseWebTest
 
 HERE = os.path.abspath(os.path.dirname(__file__))
@@ -63,8 +65,39 @@ class TestMain(BaseWebTest, unittest.TestCase):
                           '--bucket', 'bid', '--collection', 'cid'])
         assert exit_code == 0
 
+    def test_cli_keeps_existing_index_if_specified(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        body = {"data": {"index:schema": self.schema}}
+        self.app.put_json("/buckets/bid/collections/cid", body, headers=self.headers)
+
+        with mock.patch('kinto_elasticsearch.command_reindex.recreate_index') as recreate:
+            exit_code = main(['--ini', os.path.join(HERE, 'config.ini'),
+                              '--bucket', 'bid', '--collection', 'cid', '--keep-index'])
+            assert exit_code == 0
+            assert not recreate.called
+
+    def test_reindex_passes_stored_hashes(self):
+        indexer = mock.MagicMock()
+        indexer.skip_unchanged = True
+        indexer.get_hashes.return_value = {"a": "h"}
+        bulk = indexer.bulk().__enter__()
+
+        with mock.patch('kinto_elasticsearch.command_reindex.get_paginated_records',
+                        return_value=[[{"id": "a"}, {"id": "b"}]]):
+            reindex_records(indexer,
+                            mock.sentinel.storage,
+                            mock.sentinel.bucket_id,
+                            mock.sentinel.collection_id,
+                            schema=mock.sentinel.schema)
+        indexer.get_hashes.assert_called_with(mock.sentinel.bucket_id,
+                                              mock.sentinel.collection_id,
+                                              ["a", "b"])
+        hashes = [c[1]["previous_hash"] for c in bulk.index_record.call_args_list]
+        assert hashes == ["h", None]
+
     def test_cli_logs_elasticsearch_exceptions(self):
         indexer = mock.MagicMock()
+        indexer.skip_unchanged = False
         indexer.bulk().__enter__().index_record.side_effect = elasticsearch.ElasticsearchException
 
         with mock.patch('kinto_elasticsearch.command_reindex.logger') as logger:
@@ -79,6 +112,43 @@ class TestMain(BaseWebTest, unittest.TestCase):
                                                          mock.sentinel.collection_id)
                 logger.exception.assert_called_with('Failed to index record')
 
+    def test_cli_lightweight_fail_if_elasticsearch_plugin_not_installed(self):
+        with mock.patch('kinto_elasticsearch.command_reindex.logger') as logger:
+            exit_code = main(['--ini', os.path.join(HERE, 'wrong_config.ini'),
+                              '--bucket', 'bid', '--collection', 'cid', '--lightweight'])
+            assert exit_code == 62
+            logger.error.assert_called_with('kinto-elasticsearch not available.')
+
+    def test_cli_lightweight_does_not_load_the_application(self):
+        with mock.patch('pyramid.paster.bootstrap') as bootstrap:
+            exit_code = main(['--ini', os.path.join(HERE, 'config.ini'),
+                              '--bucket', 'bid', '--collection', 'cid', '--lightweight'])
+        assert exit_code == 63
+        assert not bootstrap.called
+
+    def test_postgresql_records_are_streamed(self):
+        PostgreSQL = type("Storage", (), {"__module__": "kinto.core.storage.postgresql"})
+        storage = PostgreSQL()
+        with mock.patch('kinto_elasticsearch.command_reindex.stream_records') as stream:
+            get_records_pages(storage, "bid", "cid")
+        stream.assert_called_with(storage, "bid", "cid")
+
+    def test_stream_records_fetches_rows_by_pages(self):
+        storage = mock.MagicMock()
+        conn = storage.client.connect().__enter__()
+        row = {"id": "a", "last_modified": 42, "data": {"title": "Hello"}}
+        conn.execute().fetchmany.side_effect = [[row, row], [row], []]
+
+        with mock.patch('kinto.core.utils.sqlalchemy') as sqlalchemy:
+            pages = list(stream_records(storage, "bid", "cid", limit=2))
+
+        assert [len(page) for page in pages] == [2, 1]
+        assert pages[0][0] == {"id": "a", "last_modified": 42, "title": "Hello"}
+        params = conn.execute.call_args[0][1]
+        assert params == {"parent_id": "/buckets/bid/collections/cid"}
+        options = sqlalchemy.text().execution_options.call_args[1]
+        assert options == {"stream_results": True}
+
     def test_cli_default_to_sys_argv(self):
         with mock.patch('sys.argv', ['cli', '--ini', os.path.join(HERE, 'wrong_config.ini')]):
             exit_code = main()
@@ -97,3 +167,348 @@ class TestMain(BaseWebTest, unittest.TestCase):
         for records in get_paginated_records(self.app.app.registry.storage, 'bid', 'cid', limit=3):
             page_count += 1
         assert page_count == 2
+
+
+class TestCheck(BaseWebTest, unittest.TestCase):
+
+    def test_cli_fail_if_elasticsearch_plugin_not_installed(self):
+        with mock.patch('kinto_elasticsearch.command_check.logger') as logger:
+            exit_code = command_check.main(['--ini', os.path.join(HERE, 'wrong_config.ini'),
+                                            '--bucket', 'bid', '--collection', 'cid'])
+            assert exit_code == 62
+            logger.error.assert_called_with('kinto-elasticsearch not available.')
+
+    def test_cli_fail_if_collection_or_bucket_do_not_exists(self):
+        with mock.patch('kinto_elasticsearch.command_check.logger') as logger:
+            exit_code = command_check.main(['--ini', os.path.join(HERE, 'config.ini'),
+                                            '--bucket', 'bid', '--collection', 'cid'])
+            assert exit_code == 63
+            logger.error.assert_called_with("No collection 'cid' in bucket 'bid'")
+
+    def test_cli_only_reports_on_dry_run(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+
+        with mock.patch('pyramid.paster.bootstrap',
+                        return_value={"registry": self.app.app.registry}):
+            with mock.patch('kinto_elasticsearch.command_check.check_index',
+                            return_value={"missing": 1, "stale": 2, "orphan": 3}) as check:
+                with mock.patch('sys.argv', ['cli', '--bucket', 'bid', '--collection', 'cid',
+                                             '--dry-run']):
+                    exit_code = command_check.main()
+        assert exit_code == 0
+        assert check.call_args[1]["repair"] is False
+
+    def test_cli_checks_and_clears_dirty_collections(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+        registry = self.app.app.registry
+        counts = {"missing": 0, "stale": 0, "orphan": 0}
+
+        with mock.patch('pyramid.paster.bootstrap',
+                        return_value={"registry": registry}):
+            registry.indexer.mark_dirty(registry.cache, "bid", "cid")
+            registry.indexer.mark_dirty(registry.cache, "bid", "deleted")
+            with mock.patch('kinto_elasticsearch.command_check.check_index',
+                            return_value=counts) as check_index:
+                exit_code = command_check.main(['--dirty'])
+        assert exit_code == 0
+        assert check_index.call_count == 1
+        assert check_index.call_args[0][2:] == ("bid", "cid")
+        assert registry.indexer.dirty_collections(registry.cache) == []
+
+    def test_compare_yields_differences(self):
+        stored = [{"id": "a", "last_modified": 5},
+                  {"id": "b", "last_modified": 4},
+                  {"id": "c", "last_modified": 3},
+                  {"id": "d", "last_modified": 1}]
+        indexed = [(5, "a"), (3, "x"), (2, "b"), (0, "y")]
+        result = list(command_check.compare(iter(stored), iter(indexed)))
+        assert result == [("stored", stored[1]),
+                          ("stored", stored[2]),
+                          ("indexed", (3, "x")),
+                          ("indexed", (2, "b")),
+                          ("stored", stored[3]),
+                          ("indexed", (0, "y"))]
+
+    def test_iter_indexed_paginates_with_search_after(self):
+        indexer = mock.MagicMock()
+        indexer.search.side_effect = [
+            {"hits": {"hits": [{"_id": "a", "sort": [3]}, {"_id": "b", "sort": [2]}]}},
+            {"hits": {"hits": [{"_id": "c", "sort": [1]}]}},
+        ]
+        result = list(command_check.iter_indexed(indexer, "bid", "cid", size=2))
+        assert result == [(3, "a"), (2, "b"), (1, "c")]
+        body = indexer.search.call_args[1]["body"]
+        assert body["search_after"] == [2]
+
+    def test_iter_indexed_stops_if_index_is_missing(self):
+        indexer = mock.MagicMock()
+        indexer.search.side_effect = elasticsearch.NotFoundError
+        assert list(command_check.iter_indexed(indexer, "bid", "cid")) == []
+
+    def test_check_index_repairs_missing_stale_and_orphan_documents(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+        records = []
+        for i in range(3):
+            resp = self.app.post_json("/buckets/bid/collections/cid/records",
+                                      {"data": {"n": i}}, headers=self.headers)
+            records.append(resp.json["data"])
+        missing, stale, indexed = records
+        indexer = mock.MagicMock()
+        indexer.search.return_value = {"hits": {"hits": [
+            {"_id": "orphan", "sort": [stale["last_modified"] + 10]},
+            {"_id": indexed["id"], "sort": [indexed["last_modified"]]},
+            {"_id": stale["id"], "sort": [stale["last_modified"] - 10]},
+        ]}}
+        bulk = indexer.bulk().__enter__()
+
+        counts = command_check.check_index(indexer, self.app.app.registry.storage,
+                                           "bid", "cid", batch_size=2)
+
+        assert counts == {"missing": 1, "stale": 1, "orphan": 1}
+        reindexed = [c[1]["record"]["id"] for c in bulk.index_record.call_args_list]
+        assert sorted(reindexed) == sorted([missing["id"], stale["id"]])
+        bulk.unindex_record.assert_called_with("bid", "cid", record={"id": "orphan"})
+
+    def test_check_index_marks_repaired_collections_as_indexed(self):
+        storage = mock.MagicMock()
+        storage.resource_timestamp.return_value = 42
+        indexer = mock.MagicMock()
+        indexer.search.return_value = {"hits": {"hits": []}}
+        with mock.patch('kinto_elasticsearch.command_check.get_paginated_records',
+                        return_value=[[{"id": "a", "last_modified": 1}]]):
+            command_check.check_index(indexer, storage, "bid", "cid",
+                                      cache=mock.sentinel.cache)
+        indexer.mark_indexed.assert_called_with(mock.sentinel.cache, "bid", "cid", 42)
+
+    def test_check_index_does_not_repair_on_dry_run(self):
+        indexer = mock.MagicMock()
+        indexer.search.return_value = {"hits": {"hits": []}}
+
+        with mock.patch('kinto_elasticsearch.command_check.get_paginated_records',
+                        return_value=[[{"id": "a", "last_modified": 1}]]):
+            counts = command_check.check_index(indexer, mock.sentinel.storage,
+                                               "bid", "cid", repair=False)
+        assert counts == {"missing": 1, "stale": 0, "orphan": 0}
+        assert not indexer.bulk.called
+
+    def test_check_index_logs_elasticsearch_exceptions(self):
+        indexer = mock.MagicMock()
+        indexer.search.return_value = {"hits": {"hits": []}}
+        indexer.bulk().__enter__().index_record.side_effect = (
+            elasticsearch.ElasticsearchException)
+
+        with mock.patch('kinto_elasticsearch.command_check.logger') as logger:
+            with mock.patch('kinto_elasticsearch.command_check.get_paginated_records',
+                            return_value=[[{"id": "a", "last_modified": 1}]]):
+                command_check.check_index(indexer, mock.MagicMock(), "bid", "cid",
+                                          cache=mock.sentinel.cache)
+        logger.exception.assert_called_with("Failed to repair documents")
+        indexer.mark_dirty.assert_called_with(mock.sentinel.cache, "bid", "cid")
+        assert not indexer.mark_indexed.called
+
+
+class TestDaemon(BaseWebTest, unittest.TestCase):
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+        self.indexer = mock.MagicMock(skip_unchanged=False)
+        self.indexer.search.return_value = {"aggregations": {"latest": {"value": None}}}
+        self.indexer.get_hashes.return_value = {}
+        self.indexer.indexed_timestamp.return_value = None
+        self.bulk = self.indexer.bulk().__enter__()
+        self.tailer = command_daemon.Tailer(self.indexer, self.app.app.registry.storage)
+
+    def create_record(self, data=None):
+        resp = self.app.post_json("/buckets/bid/collections/cid/records",
+                                  {"data": data or {}}, headers=self.headers)
+        return resp.json["data"]
+
+    def test_cli_fail_if_elasticsearch_plugin_not_installed(self):
+        with mock.patch('kinto_elasticsearch.command_daemon.logger') as logger:
+            exit_code = command_daemon.main(['--ini', os.path.join(HERE, 'wrong_config.ini')])
+            assert exit_code == 62
+            logger.error.assert_called_with('kinto-elasticsearch not available.')
+
+    def test_cli_runs_once(self):
+        with mock.patch('kinto_elasticsearch.command_daemon.Tailer') as tailer:
+            tailer().run.return_value = 0
+            with mock.patch('sys.argv', ['cli', '--ini', os.path.join(HERE, 'config.ini'),
+                                         '--once']):
+                exit_code = command_daemon.main()
+        assert exit_code == 0
+        assert tailer().run.call_count == 1
+
+    def test_cli_polls_until_interrupted(self):
+        with mock.patch('kinto_elasticsearch.command_daemon.Tailer') as tailer:
+            with mock.patch('kinto_elasticsearch.command_daemon.time.sleep',
+                            side_effect=[None, KeyboardInterrupt]) as sleep:
+                exit_code = command_daemon.main(['--ini', os.path.join(HERE, 'config.ini'),
+                                                 '--interval', '0.5'])
+        assert exit_code == 0
+        assert tailer().run.call_count == 2
+        sleep.assert_called_with(0.5)
+
+    def test_new_collections_are_indexed_from_the_latest_indexed_change(self):
+        self.create_record()
+        self.indexer.search.return_value = {"aggregations": {"latest": {"value": 1}}}
+        assert self.tailer.run() == 1
+        self.indexer.create_index.assert_called_with("bid", "cid", schema=None)
+        assert self.tailer.checkpoints[("bid", "cid")] > 1
+
+    def test_changes_are_indexed_since_checkpoint_by_batches(self):
+        self.tailer.batch_size = 2
+        self.tailer.run()
+        records = [self.create_record({"n": i}) for i in range(3)]
+
+        assert self.tailer.run() == 3
+        assert self.indexer.bulk.call_count == 1 + 2  # Including setUp.
+        indexed = [c[1]["record"]["id"] for c in self.bulk.index_record.call_args_list]
+        assert indexed == [record["id"] for record in records]
+        assert self.tailer.checkpoints[("bid", "cid")] == records[-1]["last_modified"]
+        assert self.tailer.run() == 0
+
+    def test_tombstones_of_indexed_documents_are_unindexed(self):
+        indexed = self.create_record()
+        unknown = self.create_record()
+        self.tailer.run()
+        self.app.delete("/buckets/bid/collections/cid/records/%s" % indexed["id"],
+                        headers=self.headers)
+        self.app.delete("/buckets/bid/collections/cid/records/%s" % unknown["id"],
+                        headers=self.headers)
+        self.indexer.get_hashes.return_value = {indexed["id"]: None}
+
+        assert self.tailer.run() == 2
+        assert self.bulk.unindex_record.call_count == 1
+        assert self.bulk.unindex_record.call_args[1]["record"]["id"] == indexed["id"]
+
+    def test_indexed_hashes_are_compared_if_unchanged_records_are_skipped(self):
+        self.tailer.run()
+        record = self.create_record()
+        self.indexer.skip_unchanged = True
+        self.indexer.get_hashes.return_value = {record["id"]: "abc"}
+        self.tailer.run()
+        assert self.bulk.index_record.call_args[1]["previous_hash"] == "abc"
+
+    def test_index_is_updated_when_schema_changes(self):
+        self.tailer.run()
+        schema = {"properties": {"title": {"type": "text"}}}
+        self.app.patch_json("/buckets/bid/collections/cid", {"data": {"index:schema": schema}},
+                            headers=self.headers)
+        self.tailer.run()
+        self.indexer.update_index.assert_called_with("bid", "cid", schema=schema)
+        self.tailer.run()
+        assert self.indexer.update_index.call_count == 1
+
+    def test_indices_of_deleted_collections_are_deleted(self):
+        self.tailer.cache = self.app.app.registry.cache
+        self.tailer.run()
+        self.app.delete("/buckets/bid/collections/cid", headers=self.headers)
+        self.tailer.run()
+        self.indexer.delete_indices.assert_called_with(collections=[("bid", "cid")])
+        self.indexer.invalidate_indexed.assert_called_with(self.tailer.cache, "bid", "cid")
+        assert self.tailer.checkpoints == {}
+
+    def test_indices_of_collections_of_deleted_buckets_are_deleted(self):
+        self.app.put("/buckets/bid-x", headers=self.headers)
+        self.app.put("/buckets/bid-x/collections/cid", headers=self.headers)
+        self.tailer.cache = self.app.app.registry.cache
+        self.tailer.run()
+        self.app.delete("/buckets/bid", headers=self.headers)
+        self.tailer.run()
+        self.indexer.delete_indices.assert_called_once_with(collections=[("bid", "cid")])
+        self.indexer.invalidate_indexed.assert_called_once_with(self.tailer.cache, "bid", "cid")
+        assert list(self.tailer.checkpoints) == [("bid-x", "cid")]
+
+    def test_indices_are_only_deleted_when_tombstones_are_read(self):
+        self.app.put("/buckets/bid/collections/cid2", headers=self.headers)
+        storage = self.app.app.registry.storage
+        list_all = storage.list_all
+
+        def capped(*args, **kwargs):
+            # Like PostgreSQL with ``storage_max_fetch_size``.
+            return list_all(*args, **kwargs)[:1]
+
+        with mock.patch.object(storage, "list_all", side_effect=capped):
+            self.tailer.run()
+            self.tailer.run()
+        assert not self.indexer.delete_indices.called
+        assert set(self.tailer.checkpoints) == {("bid", "cid"), ("bid", "cid2")}
+
+    def test_only_changed_buckets_and_collections_are_read(self):
+        self.tailer.run()
+        storage = self.app.app.registry.storage
+        with mock.patch.object(storage, "list_all", wraps=storage.list_all) as list_all:
+            self.tailer.run()
+        listed = [c[1]["resource_name"] for c in list_all.call_args_list]
+        assert listed == ["bucket", "collection", "record"]
+        for call in list_all.call_args_list:
+            assert call[1]["filters"][0].field == "last_modified"
+
+    def test_checkpoints_are_kept_in_cache(self):
+        cache = self.app.app.registry.cache
+        self.tailer.cache = cache
+        self.tailer.run()
+        record = self.create_record()
+        self.tailer.run()
+        self.indexer.mark_indexed.assert_called_with(cache, "bid", "cid",
+                                                     record["last_modified"])
+
+        self.indexer.indexed_timestamp.return_value = record["last_modified"]
+        restarted = command_daemon.Tailer(self.indexer, self.app.app.registry.storage,
+                                          cache=cache)
+        assert restarted.run() == 0
+        assert restarted.checkpoints[("bid", "cid")] == record["last_modified"]
+
+    def test_passes_without_failures_are_marked_as_caught_up(self):
+        cache = self.app.app.registry.cache
+        self.tailer.cache = cache
+        self.tailer.run()
+        assert self.indexer.mark_caught_up.called
+        self.indexer.mark_caught_up.reset_mock()
+        self.create_record()
+        self.indexer.bulk.side_effect = elasticsearch.ElasticsearchException
+        with mock.patch('kinto_elasticsearch.command_daemon.logger'):
+            self.tailer.run()
+        assert not self.indexer.mark_caught_up.called
+
+    def test_checkpoint_is_kept_if_indexing_fails(self):
+        self.tailer.run()
+        checkpoint = self.tailer.checkpoints[("bid", "cid")]
+        self.create_record()
+        self.indexer.bulk.side_effect = elasticsearch.ElasticsearchException
+        with mock.patch('kinto_elasticsearch.command_daemon.logger') as logger:
+            assert self.tailer.run() == 0
+        logger.exception.assert_called_with("Failed to index changes of %s/%s", "bid", "cid")
+        assert self.tailer.checkpoints[("bid", "cid")] == checkpoint
+
+    def test_deleted_collections_are_retried_if_deletion_fails(self):
+        self.tailer.run()
+        self.app.delete("/buckets/bid/collections/cid", headers=self.headers)
+        self.indexer.delete_indices.side_effect = elasticsearch.ElasticsearchException
+        with mock.patch('kinto_elasticsearch.command_daemon.logger') as logger:
+            self.tailer.run()
+        logger.exception.assert_called_with("Failed to delete indices")
+        assert ("bid", "cid") in self.tailer.deleted
+        self.indexer.delete_indices.side_effect = None
+        self.tailer.run()
+        self.indexer.delete_indices.assert_called_with(collections=[("bid", "cid")])
+        assert self.tailer.deleted == set()
+
+    def test_recreated_collections_are_followed_once_their_index_is_deleted(self):
+        self.tailer.run()
+        self.app.delete("/buckets/bid/collections/cid", headers=self.headers)
+        self.indexer.delete_indices.side_effect = elasticsearch.ElasticsearchException
+        with mock.patch('kinto_elasticsearch.command_daemon.logger'):
+            self.tailer.run()
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+        self.indexer.create_index.reset_mock()
+        with mock.patch('kinto_elasticsearch.command_daemon.logger'):
+            self.tailer.run()
+        assert not self.indexer.create_index.called
+        self.indexer.delete_indices.side_effect = None
+        self.tailer.run()
+        self.indexer.create_index.assert_called_with("bid", "cid", schema=None)
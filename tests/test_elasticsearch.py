@@ -3,9 +3,20 @@ import mock
 import unittest
 
 import elasticsearch
+import elasticsearch.helpers
+from kinto.core.cache.memory import Cache
+from kinto.core.storage import Filter, Sort
+from kinto.core.storage.exceptions import BackendError, RecordNotFoundError
+from kinto.core.utils import COMPARISON, msec_time
 from kinto.core.testing import get_user_headers
+from pyramid.exceptions import ConfigurationError
 
 from kinto_elasticsearch import __version__ as elasticsearch_version
+from kinto_elasticsearch.indexer import (BulkSizer, CircuitBreaker, CircuitOpenError,
+                                         HealthCheck, Indexer, HASH_FIELD, Throttle,
+                                         completion_fields, heartbeat, load_from_config)
+from kinto_elasticsearch.listing import (build_query, build_sort, FieldTypes, SearchStorage,
+                                         UnsupportedQuery)
 from . import BaseWebTest
 
 
@@ -38,6 +49,84 @@ class PluginSetup(BaseWebTest, unittest.TestCase):
             assert not resp.json["elasticsearch"]
 
 
+class HeartbeatHealthCheck(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["kinto.elasticsearch.heartbeat.check_health"] = "true"
+        settings["kinto.elasticsearch.heartbeat.max_rejections"] = "10"
+        return settings
+
+    def setUp(self):
+        self.indexer = self.app.app.registry.indexer
+        # Do not keep results between tests.
+        self.indexer.health_check.cache_ttl = 0
+        self.indexer.health_check._rejected = None
+
+    def nodes_stats(self, rejected):
+        return {"nodes": {"a": {"thread_pool": {"write": {"rejected": rejected}}},
+                          "b": {"thread_pool": {"bulk": {"rejected": 1}}}}}
+
+    def test_heartbeat_is_ok_if_cluster_is_healthy(self):
+        self.app.get("/__heartbeat__", status=200)
+
+    def test_heartbeat_fails_if_cluster_is_red(self):
+        with mock.patch.object(self.indexer.client.cluster, "health",
+                               return_value={"status": "red"}):
+            resp = self.app.get("/__heartbeat__", status=503)
+        assert not resp.json["elasticsearch"]
+
+    def test_heartbeat_fails_if_bulk_requests_are_rejected(self):
+        with mock.patch.object(self.indexer.client.nodes, "stats",
+                               side_effect=[self.nodes_stats(5), self.nodes_stats(100)]):
+            self.app.get("/__heartbeat__", status=200)
+            self.app.get("/__heartbeat__", status=503)
+
+    def test_heartbeat_fails_if_ping_fails(self):
+        with mock.patch.object(self.indexer.client, "ping", return_value=False):
+            self.app.get("/__heartbeat__", status=503)
+
+
+class HealthCheckCache(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = Indexer(hosts=[])
+        self.health = mock.patch.object(self.indexer.client.cluster, "health",
+                                        return_value={"status": "yellow"}).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_result_is_cached(self):
+        check = HealthCheck(self.indexer, cache_ttl=5)
+        assert check()
+        self.health.return_value = {"status": "red"}
+        assert check()
+        assert self.health.call_count == 1
+
+    def test_result_is_refreshed_once_expired(self):
+        check = HealthCheck(self.indexer, cache_ttl=5)
+        check()
+        self.health.return_value = {"status": "red"}
+        with mock.patch("kinto_elasticsearch.indexer.time.time", return_value=2e10):
+            assert not check()
+
+    def test_minimum_status_is_configurable(self):
+        assert not HealthCheck(self.indexer, min_status="green")()
+
+    def test_unknown_status_is_rejected(self):
+        with self.assertRaises(ConfigurationError):
+            HealthCheck(self.indexer, min_status="blue")
+
+    def test_indexing_lag_is_checked_if_configured(self):
+        cache = Cache(cache_prefix="", cache_max_size_bytes=float("inf"))
+        check = HealthCheck(self.indexer, cache_ttl=0, max_lag=60, cache=cache)
+        assert not check()
+        self.indexer.mark_caught_up(cache, msec_time() - 10 * 1000)
+        assert check()
+        self.indexer.mark_caught_up(cache, msec_time() - 120 * 1000)
+        assert not check()
+
+
 class PostActivation(BaseWebTest, unittest.TestCase):
 
     def setUp(self):
@@ -106,6 +195,17 @@ class RecordIndexing(BaseWebTest, unittest.TestCase):
                                    headers=self.headers)
             assert r.status_code == 201
 
+    def test_collection_is_marked_as_dirty_if_indexer_fails(self):
+        indexer = self.app.app.registry.indexer
+        cache = self.app.app.registry.cache
+        self.addCleanup(indexer.clear_dirty, cache, [("bid", "cid")])
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk",
+                        side_effect=CircuitOpenError(30)):
+            self.app.post_json("/buckets/bid/collections/cid/records",
+                               {"data": {"hola": "mundo"}},
+                               headers=self.headers)
+        assert indexer.dirty_collections(cache) == [("bid", "cid")]
+
     def test_a_statsd_timer_is_used_if_configured(self):
         statsd_client = self.app.app.registry.statsd._client
         with mock.patch.object(statsd_client, 'timing') as mocked:
@@ -115,6 +215,941 @@ class RecordIndexing(BaseWebTest, unittest.TestCase):
             timers = set(c[0][0] for c in mocked.call_args_list)
             assert 'plugins.elasticsearch.index' in timers
 
+    def test_bulk_steps_are_measured_if_statsd_is_configured(self):
+        statsd_client = self.app.app.registry.statsd._client
+        with mock.patch.object(statsd_client, 'timing') as timing:
+            with mock.patch.object(statsd_client, 'incr') as incr:
+                self.app.post_json("/buckets/bid/collections/cid/records",
+                                   {"data": {"hola": "mundo"}},
+                                   headers=self.headers)
+        timers = set(c[0][0] for c in timing.call_args_list)
+        assert {'plugins.elasticsearch.bulk.build',
+                'plugins.elasticsearch.bulk.serialize',
+                'plugins.elasticsearch.bulk.send'}.issubset(timers)
+        counters = {c[0][0]: c[1]["count"] for c in incr.call_args_list}
+        assert counters['plugins.elasticsearch.bulk.items'] == 1
+        assert counters['plugins.elasticsearch.bulk.bytes'] > 0
+
+
+class BulkSizing(unittest.TestCase):
+
+    def setUp(self):
+        self.sizer = BulkSizer(initial=4, minimum=2, maximum=8, increment=2,
+                               target_duration=1.0)
+        self.indexer = Indexer(hosts=[], sizer=self.sizer, max_retries=1)
+        self.operations = [{"_op_type": "delete", "_index": "i", "_id": i} for i in range(10)]
+        patch = mock.patch("kinto_elasticsearch.indexer.time.sleep")
+        self.sleep = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_chunk_size_grows_additively_when_fast(self):
+        self.sizer.succeeded(0.1)
+        assert self.sizer.chunk_size == 6
+        self.sizer.succeeded(0.1)
+        self.sizer.succeeded(0.1)
+        assert self.sizer.chunk_size == 8
+
+    def test_chunk_size_is_halved_when_slow_or_rejected(self):
+        self.sizer.succeeded(2.0)
+        assert self.sizer.chunk_size == 2
+        self.sizer.rejected()
+        assert self.sizer.chunk_size == 2
+
+    def test_operations_are_sent_by_chunks_of_adapted_size(self):
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk") as bulk:
+            self.indexer.send(self.operations)
+        sizes = [len(c[0][1]) for c in bulk.call_args_list]
+        assert sizes == [4, 6]
+        assert bulk.call_args_list[0][1]["max_chunk_bytes"] == self.indexer.max_chunk_bytes
+
+    def test_operations_are_consumed_one_chunk_at_a_time(self):
+        consumed = []
+
+        def generate():
+            for operation in self.operations:
+                consumed.append(operation)
+                yield operation
+
+        def bulk(client, chunk, **kwargs):
+            sizes.append(len(chunk))
+            # Only the chunk being sent was taken from the generator.
+            assert len(consumed) == sum(sizes)
+
+        sizes = []
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk",
+                        side_effect=bulk):
+            assert self.indexer.send(generate()) == 10
+        assert sizes == [4, 6]
+
+    def test_full_chunks_are_sent_while_operations_are_added(self):
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk") as bulk:
+            with self.indexer.bulk() as client:
+                for i in range(5):
+                    client.unindex_record("bid", "cid", record={"id": str(i)})
+                assert bulk.call_count == 1
+                assert len(client.operations) == 1
+        sizes = [len(c[0][1]) for c in bulk.call_args_list]
+        assert sizes == [4, 1]
+        assert len(client) == 5
+
+    def test_chunks_are_cut_by_size_before_being_sent(self):
+        self.indexer.max_chunk_bytes = 200
+        operations = [{"_op_type": "index", "_index": "i", "_id": str(i),
+                       "_source": {"text": "a" * 50}} for i in range(4)]
+
+        def bulk(body, **kwargs):
+            items = [{"index": {"status": 200}} for _ in range(body.count('{"index"'))]
+            return {"errors": False, "items": items}
+
+        with mock.patch.object(self.indexer.client, "bulk", side_effect=bulk) as client_bulk:
+            with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk",
+                            wraps=elasticsearch.helpers.bulk) as helpers_bulk:
+                assert self.indexer.send(operations) == 4
+        assert [len(c[0][1]) for c in helpers_bulk.call_args_list] == [2, 2]
+        # The helpers did not split the chunks: one request per chunk.
+        assert client_bulk.call_count == 2
+
+    def test_rejected_requests_are_retried_with_smaller_chunks(self):
+        rejected = elasticsearch.TransportError(429, "es_rejected_execution_exception")
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk",
+                        side_effect=[rejected, None, None, None, None, None]) as bulk:
+            self.indexer.send(self.operations)
+        sizes = [len(c[0][1]) for c in bulk.call_args_list]
+        assert sizes == [4, 2, 4, 4]
+        self.sleep.assert_called_once_with(1.0)
+
+    def test_retries_wait_longer_after_each_rejection(self):
+        self.indexer.max_retries = 3
+        rejected = elasticsearch.TransportError(429, "es_rejected_execution_exception")
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk",
+                        side_effect=[rejected, rejected, rejected] + [None] * 10):
+            self.indexer.send(self.operations)
+        assert [c[0][0] for c in self.sleep.call_args_list] == [1.0, 2.0, 4.0]
+
+    def test_retries_are_counted_per_chunk(self):
+        rejected = elasticsearch.TransportError(429, "es_rejected_execution_exception")
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk",
+                        side_effect=[rejected, None, rejected] + [None] * 10) as bulk:
+            self.indexer.send(self.operations)
+        sizes = [len(c[0][1]) for c in bulk.call_args_list]
+        assert sum(sizes) - sizes[0] - sizes[2] == len(self.operations)
+        assert [c[0][0] for c in self.sleep.call_args_list] == [1.0, 1.0]
+
+    def test_rejections_are_raised_once_retries_are_exhausted(self):
+        rejected = elasticsearch.TransportError(413, "request too large")
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk",
+                        side_effect=rejected):
+            with self.assertRaises(elasticsearch.TransportError):
+                self.indexer.send(self.operations)
+        assert self.sizer.chunk_size == 2
+
+    def test_other_transport_errors_are_raised(self):
+        error = elasticsearch.TransportError(500, "boom")
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk",
+                        side_effect=error):
+            with self.assertRaises(elasticsearch.TransportError):
+                self.indexer.send(self.operations)
+        assert self.sizer.chunk_size == 4
+
+    def test_rejected_items_shrink_chunks(self):
+        errors = [{"index": {"_id": "a", "status": 429}}]
+        error = elasticsearch.helpers.BulkIndexError("1 document(s) failed to index.", errors)
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk",
+                        side_effect=error):
+            with self.assertRaises(elasticsearch.helpers.BulkIndexError):
+                self.indexer.send(self.operations)
+        assert self.sizer.chunk_size == 2
+
+    def test_failed_items_do_not_shrink_chunks(self):
+        errors = [{"delete": {"_id": "a", "status": 404}}]
+        error = elasticsearch.helpers.BulkIndexError("1 document(s) failed to index.", errors)
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk",
+                        side_effect=error):
+            with self.assertRaises(elasticsearch.helpers.BulkIndexError):
+                self.indexer.send(self.operations)
+        assert self.sizer.chunk_size == 4
+
+
+class CircuitBreaking(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_rate=0.5, window=4, slow_call_duration=1.0,
+                                      reset_timeout=30)
+        self.indexer = Indexer(hosts=[], circuit_breaker=self.breaker)
+        self.search = mock.patch.object(self.indexer.client, "search",
+                                        return_value={}).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def trip(self):
+        for failed in (True, False, True, False):
+            self.breaker.record(0.1, failed=failed)
+
+    def test_breaker_opens_once_failure_rate_is_reached(self):
+        self.breaker.record(0.1, failed=True)
+        self.breaker.record(0.1, failed=True)
+        assert self.breaker.state == CircuitBreaker.CLOSED
+        self.breaker.record(0.1)
+        assert self.breaker.record(0.1)
+        assert self.breaker.state == CircuitBreaker.OPEN
+
+    def test_slow_calls_count_as_failures(self):
+        for _ in range(4):
+            self.breaker.record(2.0)
+        assert self.breaker.state == CircuitBreaker.OPEN
+
+    def test_calls_fail_fast_while_open(self):
+        self.trip()
+        with self.assertRaises(CircuitOpenError) as cm:
+            self.indexer.search("bid", "cid")
+        assert cm.exception.retry_after == 30
+        assert not self.search.called
+
+    def test_a_single_probe_is_allowed_once_reset_timeout_is_elapsed(self):
+        self.trip()
+        with mock.patch("kinto_elasticsearch.indexer.time.time", return_value=2e10):
+            assert self.breaker.allow()
+            assert self.breaker.state == CircuitBreaker.HALF_OPEN
+            assert not self.breaker.allow()
+
+    def test_successful_probe_closes_the_breaker(self):
+        self.trip()
+        with mock.patch("kinto_elasticsearch.indexer.time.time", return_value=2e10):
+            self.indexer.search("bid", "cid")
+        assert self.breaker.state == CircuitBreaker.CLOSED
+        assert len(self.breaker.outcomes) == 0
+
+    def test_outcomes_recorded_while_open_are_ignored(self):
+        self.trip()
+        self.breaker.record(0.1)
+        assert self.breaker.state == CircuitBreaker.OPEN
+        assert not self.breaker.allow()
+        assert list(self.breaker.outcomes) == [True, False, True, False]
+
+    def test_calls_started_before_the_probe_are_ignored(self):
+        self.trip()
+        with mock.patch("kinto_elasticsearch.indexer.time.time", return_value=2e10):
+            assert self.breaker.allow()
+            self.breaker.record(0.1, started=2e10 - 60)
+        assert self.breaker.state == CircuitBreaker.HALF_OPEN
+
+    def test_failed_probe_opens_the_breaker_again(self):
+        self.trip()
+        self.search.side_effect = elasticsearch.ConnectionTimeout("N/A", "timeout", None)
+        with mock.patch("kinto_elasticsearch.indexer.time.time", return_value=2e10):
+            with self.assertRaises(elasticsearch.ConnectionTimeout):
+                self.indexer.search("bid", "cid")
+            assert self.breaker.state == CircuitBreaker.OPEN
+            assert not self.breaker.allow()
+
+    def test_only_unavailability_counts_as_failure(self):
+        self.search.side_effect = [elasticsearch.RequestError(400, "parsing_exception"),
+                                   elasticsearch.TransportError(503, "unavailable")]
+        for _ in range(2):
+            with self.assertRaises(elasticsearch.TransportError):
+                self.indexer.search("bid", "cid")
+        assert list(self.breaker.outcomes) == [False, True]
+
+    def test_circuit_breaker_is_configurable(self):
+        config = mock.MagicMock()
+        config.get_settings.return_value = {
+            "elasticsearch.circuit_breaker.enabled": "true",
+            "elasticsearch.circuit_breaker.window": "10",
+            "elasticsearch.circuit_breaker.slow_call_duration": "2.5",
+        }
+        breaker = load_from_config(config).circuit_breaker
+        assert breaker.outcomes.maxlen == 10
+        assert breaker.slow_call_duration == 2.5
+        assert breaker.reset_timeout == 30
+
+
+class ClustersRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.mirror = mock.MagicMock()
+        self.indexer = Indexer(hosts=["indexing:9200"], search_hosts=["search:9200"],
+                               mirrors=[self.mirror])
+
+    def test_searches_are_sent_to_search_hosts(self):
+        assert self.indexer.search_client is not self.indexer.client
+        with mock.patch.object(self.indexer.search_client, "search",
+                               return_value={}) as search:
+            self.indexer.search("bid", "cid")
+        assert search.called
+
+    def test_clients_are_created_on_first_use(self):
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.Elasticsearch") as client:
+            indexer = Indexer(hosts=["indexing:9200"], search_hosts=["search:9200"])
+            assert not client.called
+            indexer.search_client
+            client.assert_called_with(["search:9200"])
+            indexer.client
+            indexer.client
+            client.assert_called_with(["indexing:9200"])
+        assert client.call_count == 2
+
+    def test_search_client_defaults_to_indexing_client(self):
+        indexer = Indexer(hosts=[])
+        assert indexer.search_client is indexer.client
+
+    def test_bulk_operations_are_sent_to_every_cluster(self):
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk") as bulk:
+            with self.indexer.bulk() as client:
+                client.unindex_record("bid", "cid", record={"id": "a"})
+        assert bulk.call_args[0][0] is self.indexer.client
+        operations = self.mirror.send.call_args[0][0]
+        assert operations[0]["_id"] == "a"
+
+    def test_bulk_operations_are_mirrored_even_if_primary_fails(self):
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk",
+                        side_effect=elasticsearch.ConnectionError("N/A", "down", None)):
+            with self.assertRaises(elasticsearch.ConnectionError):
+                with self.indexer.bulk() as client:
+                    client.unindex_record("bid", "cid", record={"id": "a"})
+        assert self.mirror.send.called
+
+    def test_indices_changes_are_mirrored(self):
+        with mock.patch.object(self.indexer.client.indices, "put_mapping"):
+            self.indexer.update_index("bid", "cid", {"properties": {}})
+        with mock.patch.object(self.indexer.client.indices, "delete"):
+            self.indexer.delete_indices(collections=[("bid", "cid")])
+        self.mirror.update_index.assert_called_with("bid", "cid", {"properties": {}})
+        self.mirror.delete_indices.assert_called_with(bucket_ids=(),
+                                                      collections=[("bid", "cid")],
+                                                      keep=())
+
+    def test_mirrors_are_called_after_the_primary_cluster(self):
+        calls = []
+        self.mirror.create_index.side_effect = lambda *args: calls.append("mirror")
+        with mock.patch.object(self.indexer.client.indices, "exists",
+                               side_effect=lambda **kw: calls.append("primary")):
+            with mock.patch.object(self.indexer.client.indices, "create"):
+                self.indexer.create_index("bid", "cid")
+        assert calls == ["primary", "mirror"]
+
+    def test_mirrors_are_called_even_if_primary_fails(self):
+        with mock.patch.object(self.indexer.client.indices, "delete",
+                               side_effect=elasticsearch.ConnectionError("N/A", "down", None)):
+            with self.assertRaises(elasticsearch.ConnectionError):
+                self.indexer.delete_indices(collections=[("bid", "cid")])
+        assert self.mirror.delete_indices.called
+
+    def test_mirrors_with_open_circuit_are_skipped_silently(self):
+        self.mirror.flush.side_effect = CircuitOpenError(retry_after=30)
+        with mock.patch.object(self.indexer, "_resolve_indices", return_value=[]), \
+                mock.patch.object(self.indexer, "_delete_scripts"):
+            with mock.patch("kinto_elasticsearch.indexer.logger") as logger:
+                with mock.patch.object(self.indexer, "count") as count:
+                    self.indexer.flush()
+        assert not logger.exception.called
+        count.assert_called_with("mirrors.skipped")
+
+    def test_mirrors_have_their_own_circuit_breaker_and_timeout(self):
+        config = mock.MagicMock()
+        config.get_settings.return_value = {
+            "elasticsearch.dual_write_hosts": "backup:9200",
+            "elasticsearch.dual_write_timeout": "2",
+        }
+        indexer = load_from_config(config)
+        mirror, = indexer.mirrors
+        assert indexer.circuit_breaker is None
+        assert isinstance(mirror.circuit_breaker, CircuitBreaker)
+        assert mirror.timeout == 2
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.Elasticsearch") as client:
+            mirror.client
+        client.assert_called_with(["backup:9200"], timeout=2)
+
+    def test_mirrors_failures_are_logged_but_not_raised(self):
+        self.mirror.flush.side_effect = elasticsearch.ConnectionError("N/A", "down", None)
+        with mock.patch.object(self.indexer, "_resolve_indices", return_value=[]), \
+                mock.patch.object(self.indexer, "_delete_scripts"):
+            with mock.patch("kinto_elasticsearch.indexer.logger") as logger:
+                self.indexer.flush()
+        assert logger.exception.called
+
+    def test_heartbeat_pings_the_search_hosts(self):
+        request = mock.MagicMock()
+        request.registry.indexer = self.indexer
+        with mock.patch.object(self.indexer.client, "ping", return_value=True):
+            with mock.patch.object(self.indexer.search_client, "ping", return_value=False):
+                assert not heartbeat(request)
+
+    def test_clusters_are_configurable(self):
+        config = mock.MagicMock()
+        config.get_settings.return_value = {
+            "elasticsearch.hosts": "a:9200",
+            "elasticsearch.search_hosts": "b:9200 c:9200",
+            "elasticsearch.dual_write_hosts": "d:9200, e:9200\nf:9200",
+        }
+        indexer = load_from_config(config)
+        assert len(indexer.search_client.transport.hosts) == 2
+        hosts = [len(mirror.client.transport.hosts) for mirror in indexer.mirrors]
+        assert hosts == [2, 1]
+        assert indexer.mirrors[0].sizer is not indexer.sizer
+
+
+class DirtyCollections(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = Indexer(hosts=[])
+        self.cache = Cache(cache_prefix="", cache_max_size_bytes=float("inf"))
+
+    def test_collections_are_marked_once(self):
+        self.indexer.mark_dirty(self.cache, "bid", "cid")
+        self.indexer.mark_dirty(self.cache, "bid", "cid")
+        self.indexer.mark_dirty(self.cache, "bid", "other")
+        assert self.indexer.dirty_collections(self.cache) == [("bid", "cid"), ("bid", "other")]
+
+    def test_cleared_collections_are_removed(self):
+        self.indexer.mark_dirty(self.cache, "bid", "cid")
+        self.indexer.mark_dirty(self.cache, "bid", "other")
+        self.indexer.clear_dirty(self.cache, [("bid", "cid")])
+        assert self.indexer.dirty_collections(self.cache) == [("bid", "other")]
+        self.indexer.clear_dirty(self.cache, [("bid", "other")])
+        assert self.indexer.dirty_collections(self.cache) == []
+
+    def test_indexed_timestamp_only_moves_forward(self):
+        self.indexer.mark_indexed(self.cache, "bid", "cid", 42)
+        self.indexer.mark_indexed(self.cache, "bid", "cid", 41)
+        assert self.indexer.indexed_timestamp(self.cache, "bid", "cid") == 42
+
+    def test_indexed_timestamp_is_dropped_while_dirty(self):
+        self.indexer.mark_indexed(self.cache, "bid", "cid", 42)
+        self.indexer.mark_dirty(self.cache, "bid", "cid")
+        self.indexer.mark_indexed(self.cache, "bid", "cid", 43)
+        assert self.indexer.indexed_timestamp(self.cache, "bid", "cid") is None
+
+
+class Instrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.statsd = mock.MagicMock()
+        self.tracer = mock.MagicMock()
+        self.indexer = Indexer(hosts=[], statsd=self.statsd, tracer=self.tracer)
+
+    def counters(self):
+        return {c[0][0]: c[0][1] for c in self.statsd.count.call_args_list}
+
+    def test_calls_are_timed_and_traced(self):
+        with mock.patch.object(self.indexer.client, "search", return_value={"took": 12}):
+            self.indexer.search("bid", "cid")
+        self.statsd.timer.assert_called_with("plugins.elasticsearch.search")
+        self.tracer.start_as_current_span.assert_called_with("elasticsearch.search",
+                                                             attributes={"index": "kinto-bid-cid"})
+
+    def test_search_took_is_counted(self):
+        with mock.patch.object(self.indexer.client, "search", return_value={"took": 12}):
+            self.indexer.search("bid", "cid")
+        assert self.counters()["plugins.elasticsearch.search.took"] == 12
+
+    def test_bulk_items_and_bytes_are_counted(self):
+        operations = [{"_op_type": "index", "_index": "i", "_id": "a", "_source": {"a": 1}},
+                      {"_op_type": "delete", "_index": "i", "_id": "b"}]
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk") as bulk:
+            self.indexer.send(operations)
+        counters = self.counters()
+        assert counters["plugins.elasticsearch.bulk.items"] == 2
+        assert counters["plugins.elasticsearch.bulk.bytes"] == len('{"a":1}')
+        # Sources are sent serialized, without altering the operations.
+        assert bulk.call_args[0][1][0]["_source"] == '{"a":1}'
+        assert operations[0]["_source"] == {"a": 1}
+
+    def test_bulk_failures_are_counted(self):
+        errors = [{"index": {"_id": "a", "status": 400}}]
+        error = elasticsearch.helpers.BulkIndexError("1 document(s) failed to index.", errors)
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk",
+                        side_effect=error):
+            with self.assertRaises(elasticsearch.helpers.BulkIndexError):
+                self.indexer.send([{"_op_type": "delete", "_index": "i", "_id": "a"}])
+        assert self.counters()["plugins.elasticsearch.bulk.failures"] == 1
+
+    def test_tracing_can_be_enabled_from_settings(self):
+        config = mock.MagicMock()
+        config.get_settings.return_value = {"elasticsearch.tracing": "true"}
+        indexer = load_from_config(config)
+        assert indexer.tracer is not None
+        with indexer.instrument("search", index="kinto-bid-cid"):
+            pass
+
+    def test_nothing_is_measured_if_disabled(self):
+        indexer = Indexer(hosts=[])
+        with indexer.instrument("search"):
+            indexer.count("search.requests")
+
+
+class ContentHashing(unittest.TestCase):
+
+    schema = {
+        "properties": {
+            "title": {"type": "text"},
+            "build": {
+                "properties": {
+                    "id": {"type": "keyword"}
+                }
+            }
+        }
+    }
+
+    def setUp(self):
+        self.indexer = Indexer(hosts=[], skip_unchanged=True)
+        self.record = {"id": "abc", "last_modified": 42, "title": "Hello",
+                       "build": {"id": "efg", "notes": "blah"}, "blob": "xyz"}
+
+    def test_hash_ignores_last_modified_and_unmapped_fields(self):
+        touched = dict(self.record, last_modified=43, blob="zyx",
+                       build={"id": "efg", "notes": "bloh"})
+        assert self.indexer.record_hash("bid", "cid", self.record, self.schema) == \
+            self.indexer.record_hash("bid", "cid", touched, self.schema)
+
+    def test_hash_changes_with_mapped_fields(self):
+        changed = dict(self.record, build={"id": "hij"})
+        assert self.indexer.record_hash("bid", "cid", self.record, self.schema) != \
+            self.indexer.record_hash("bid", "cid", changed, self.schema)
+
+    def test_hash_covers_whole_record_without_schema(self):
+        changed = dict(self.record, blob="zyx")
+        assert self.indexer.record_hash("bid", "cid", self.record) != \
+            self.indexer.record_hash("bid", "cid", changed)
+
+    def test_unchanged_records_are_skipped(self):
+        previous_hash = self.indexer.record_hash("bid", "cid", self.record, self.schema)
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk"):
+            with self.indexer.bulk() as bulk:
+                bulk.index_record("bid", "cid", self.record, schema=self.schema,
+                                  previous_hash=previous_hash)
+        assert bulk.operations == []
+
+    def test_last_modified_of_unchanged_records_is_updated_for_listing(self):
+        self.indexer.records_listing = True
+        previous_hash = self.indexer.record_hash("bid", "cid", self.record, self.schema)
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk") as helper:
+            with self.indexer.bulk() as bulk:
+                bulk.index_record("bid", "cid", self.record, schema=self.schema,
+                                  previous_hash=previous_hash)
+        operation, = helper.call_args[0][1]
+        assert operation["_op_type"] == "update"
+        assert operation["doc"] == {"last_modified": 42}
+        # The documents are searchable once the request returns.
+        assert helper.call_args[1]["refresh"] == "wait_for"
+
+    def test_hash_is_stored_with_the_document(self):
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk"):
+            with self.indexer.bulk() as bulk:
+                bulk.index_record("bid", "cid", self.record, schema=self.schema,
+                                  previous_hash="old")
+        source = bulk.operations[0]["_source"]
+        expected = self.indexer.record_hash("bid", "cid", self.record, self.schema)
+        assert source[HASH_FIELD] == expected
+        assert HASH_FIELD not in self.record
+
+    def test_hash_field_is_added_to_mapping(self):
+        mapping = self.indexer._mapping(self.schema)
+        assert mapping["properties"][HASH_FIELD]["index"] is False
+        assert HASH_FIELD not in self.schema["properties"]
+
+    def test_stored_hashes_are_fetched_for_found_documents(self):
+        docs = [{"_id": "a", "found": True, "_source": {HASH_FIELD: "h"}},
+                {"_id": "b", "found": False}]
+        with mock.patch.object(self.indexer.client, "mget",
+                               return_value={"docs": docs}) as mget:
+            hashes = self.indexer.get_hashes("bid", "cid", ["a", "b"])
+        assert hashes == {"a": "h"}
+        assert mget.call_args[1]["_source_includes"] == [HASH_FIELD]
+
+    def test_stored_hashes_are_empty_if_index_is_missing(self):
+        with mock.patch.object(self.indexer.client, "mget",
+                               side_effect=elasticsearch.NotFoundError):
+            assert self.indexer.get_hashes("bid", "cid", ["a"]) == {}
+
+
+class SchemaProjection(unittest.TestCase):
+
+    schema = ContentHashing.schema
+
+    def setUp(self):
+        self.indexer = Indexer(hosts=[], schema_fields_only=True)
+        self.record = {"id": "abc", "last_modified": 42, "title": "Hello",
+                       "build": {"id": "efg", "notes": "blah"},
+                       "attachment": {"location": "x", "base64": "abcdef"}}
+
+    def index(self, record, schema):
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk"):
+            with self.indexer.bulk() as bulk:
+                bulk.index_record("bid", "cid", record, schema=schema)
+        return bulk.operations[0]["_source"]
+
+    def test_only_schema_fields_are_indexed(self):
+        source = self.index(self.record, self.schema)
+        assert source == {"id": "abc", "last_modified": 42, "title": "Hello",
+                          "build": {"id": "efg"}}
+
+    def test_lists_of_objects_are_projected(self):
+        record = dict(self.record, build=[{"id": "a", "notes": "b"}, {"id": "c"}])
+        source = self.index(record, self.schema)
+        assert source["build"] == [{"id": "a"}, {"id": "c"}]
+
+    def test_whole_record_is_indexed_without_schema(self):
+        assert self.index(self.record, None) == self.record
+
+    def test_projection_is_compiled_once_per_collection(self):
+        with mock.patch("kinto_elasticsearch.indexer.schema_fields",
+                        return_value={}) as compiled:
+            self.indexer.projection("bid", "cid", self.schema)
+            self.indexer.projection("bid", "cid", self.schema)
+        assert compiled.call_count == 1
+
+    def test_projection_is_compiled_again_if_schema_changes(self):
+        self.indexer.projection("bid", "cid", self.schema)
+        fields = self.indexer.projection("bid", "cid", {"properties": {"a": {}}})
+        assert sorted(fields.keys()) == ["a", "id", "last_modified"]
+
+    def test_projection_is_dropped_when_index_is_deleted(self):
+        self.indexer.projection("bid", "cid", self.schema)
+        self.indexer.projection("bid2", "cid", self.schema)
+        indices = self.indexer.client.indices
+        with mock.patch.object(indices, "get_alias", return_value={"kinto-bid-cid": {}}):
+            with mock.patch.object(indices, "delete"), \
+                    mock.patch.object(self.indexer, "_delete_scripts"):
+                self.indexer.delete_index("bid")
+        assert list(self.indexer._projections.keys()) == ["kinto-bid2-cid"]
+
+
+class CollectionMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = Indexer(hosts=[], metadata_ttl=60)
+        self.cache = Cache(cache_prefix="", cache_max_size_bytes=1000)
+        self.storage = mock.MagicMock()
+        self.storage.get.return_value = {"id": "cid", "index:schema": {}}
+
+    def get(self, bucket_id="bid", collection_id="cid"):
+        return self.indexer.get_collection(self.storage, self.cache, bucket_id, collection_id)
+
+    def test_metadata_is_read_from_storage_once(self):
+        assert self.get() == {"id": "cid", "index:schema": {}}
+        assert self.get() == {"id": "cid", "index:schema": {}}
+        assert self.storage.get.call_count == 1
+
+    def test_missing_collection_is_cached_as_none(self):
+        self.storage.get.side_effect = RecordNotFoundError
+        assert self.get() is None
+        assert self.get() is None
+        assert self.storage.get.call_count == 1
+
+    def test_metadata_is_read_again_once_expired(self):
+        self.get()
+        with mock.patch("kinto_elasticsearch.indexer.time.time", return_value=2e10):
+            self.get()
+        assert self.storage.get.call_count == 2
+
+    def test_metadata_is_read_again_once_invalidated(self):
+        self.get()
+        self.get(collection_id="cid2")
+        self.get(bucket_id="bid2")
+        self.indexer.invalidate_collections(self.cache, "bid")
+        self.get()
+        self.get(collection_id="cid2")
+        self.get(bucket_id="bid2")
+        assert self.storage.get.call_count == 5
+
+    def test_metadata_is_read_again_if_invalidated_by_another_process(self):
+        other = Indexer(hosts=[], metadata_ttl=60)
+        self.get()
+        other.invalidate_collections(self.cache, "bid")
+        self.get()
+        self.get()
+        assert self.storage.get.call_count == 2
+
+
+class UnchangedRecordIndexing(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["kinto.elasticsearch.skip_unchanged"] = "true"
+        return settings
+
+    def setUp(self):
+        schema = {"properties": {"title": {"type": "text"}}}
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put_json("/buckets/bid/collections/cid",
+                          {"data": {"index:schema": schema}},
+                          headers=self.headers)
+        resp = self.app.post_json("/buckets/bid/collections/cid/records",
+                                  {"data": {"title": "Hello", "blob": "abc"}},
+                                  headers=self.headers)
+        self.record = resp.json["data"]
+
+    def test_hash_is_indexed_with_record(self):
+        indexer = self.app.app.registry.indexer
+        hashes = indexer.get_hashes("bid", "cid", [self.record["id"]])
+        assert hashes[self.record["id"]] is not None
+
+    def test_hash_is_not_returned_in_search_results(self):
+        resp = self.app.post("/buckets/bid/collections/cid/search",
+                             headers=self.headers)
+        source = resp.json["hits"]["hits"][0]["_source"]
+        assert source["title"] == self.record["title"]
+        assert HASH_FIELD not in source
+
+    def test_update_of_unmapped_fields_is_not_sent(self):
+        url = "/buckets/bid/collections/cid/records/{}".format(self.record["id"])
+        with mock.patch("kinto_elasticsearch.indexer.elasticsearch.helpers.bulk") as bulk:
+            self.app.patch_json(url, {"data": {"blob": "def"}}, headers=self.headers)
+            assert not bulk.called
+
+    def test_collection_metadata_is_not_read_on_every_write(self):
+        url = "/buckets/bid/collections/cid/records/{}".format(self.record["id"])
+        self.app.patch_json(url, {"data": {"title": "Bonjour"}}, headers=self.headers)
+        storage = self.app.app.registry.storage
+        with mock.patch.object(storage, "get", wraps=storage.get) as get:
+            self.app.patch_json(url, {"data": {"title": "Hola"}}, headers=self.headers)
+            collections = [c for c in get.call_args_list
+                           if c[1].get("collection_id") == "collection"]
+            assert len(collections) == 0
+
+    def test_update_of_mapped_fields_is_sent(self):
+        url = "/buckets/bid/collections/cid/records/{}".format(self.record["id"])
+        self.app.patch_json(url, {"data": {"title": "Bonjour"}}, headers=self.headers)
+        resp = self.app.post("/buckets/bid/collections/cid/search",
+                             headers=self.headers)
+        assert resp.json["hits"]["hits"][0]["_source"]["title"] == "Bonjour"
+
+
+class SchemaFieldsIndexing(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["kinto.elasticsearch.index_schema_fields_only"] = "true"
+        return settings
+
+    def setUp(self):
+        schema = {"properties": {"title": {"type": "text"}}}
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put_json("/buckets/bid/collections/cid",
+                          {"data": {"index:schema": schema}},
+                          headers=self.headers)
+        self.app.post_json("/buckets/bid/collections/cid/records",
+                           {"data": {"title": "Hello", "blob": "abc"}},
+                           headers=self.headers)
+
+    def test_only_schema_fields_are_indexed(self):
+        resp = self.app.post("/buckets/bid/collections/cid/search",
+                             headers=self.headers)
+        source = resp.json["hits"]["hits"][0]["_source"]
+        assert sorted(source.keys()) == ["id", "last_modified", "title"]
+
+
+class QueryTranslation(unittest.TestCase):
+
+    def setUp(self):
+        self.types = FieldTypes({"properties": {
+            "age": {"type": "long"},
+            "title": {"type": "text"},
+            "build": {"properties": {"id": {"type": "keyword"}}},
+        }})
+
+    def test_filters_are_combined(self):
+        filters = [Filter("age", 12, COMPARISON.MIN),
+                   Filter("build.id", "abc", COMPARISON.NOT),
+                   Filter("id", ["a", "b"], COMPARISON.IN),
+                   Filter("age", False, COMPARISON.HAS)]
+        assert build_query(filters, None, self.types) == {"bool": {
+            "filter": [{"range": {"age": {"gte": 12}}},
+                       {"terms": {"_id": ["a", "b"]}}],
+            "must_not": [{"term": {"build.id": "abc"}},
+                         {"exists": {"field": "age"}}],
+        }}
+
+    def test_pagination_rules_are_alternatives(self):
+        rules = [[Filter("last_modified", 10, COMPARISON.LT)],
+                 [Filter("last_modified", 10, COMPARISON.EQ),
+                  Filter("age", 3, COMPARISON.GT)]]
+        query = build_query([], rules, self.types)
+        assert query == {"bool": {"filter": [{"bool": {
+            "should": [{"bool": {"filter": [{"range": {"last_modified": {"lt": 10}}}]}},
+                       {"bool": {"filter": [{"term": {"last_modified": 10}},
+                                            {"range": {"age": {"gt": 3}}}]}}],
+            "minimum_should_match": 1,
+        }}]}}
+
+    def test_sorting_is_translated(self):
+        sorting = [Sort("age", -1), Sort("last_modified", 1)]
+        assert build_sort(sorting, self.types) == [
+            {"age": {"order": "desc", "unmapped_type": "long"}},
+            {"last_modified": {"order": "asc", "unmapped_type": "long"}}]
+
+    def test_fields_must_be_comparable_like_in_storage(self):
+        for field in ("title", "unknown", "build"):
+            with self.assertRaises(UnsupportedQuery):
+                build_query([Filter(field, "a", COMPARISON.EQ)], None, self.types)
+        with self.assertRaises(UnsupportedQuery):
+            build_sort([Sort("id", 1)], self.types)
+
+    def test_unsupported_operators_are_rejected(self):
+        with self.assertRaises(UnsupportedQuery):
+            build_query([Filter("build.id", "a*", COMPARISON.LIKE)], None, self.types)
+        with self.assertRaises(UnsupportedQuery):
+            build_query([Filter("id", "a", COMPARISON.GT)], None, self.types)
+
+
+class RecordsListing(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["kinto.elasticsearch.records_listing"] = "true"
+        return settings
+
+    def setUp(self):
+        schema = {"properties": {"age": {"type": "long"}}}
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put_json("/buckets/bid/collections/cid",
+                          {"data": {"index:schema": schema}},
+                          headers=self.headers)
+        self.records = []
+        for age in (12, 21, 30):
+            resp = self.app.post_json("/buckets/bid/collections/cid/records",
+                                      {"data": {"age": age}}, headers=self.headers)
+            self.records.append(resp.json["data"])
+        self.search = mock.patch("kinto_elasticsearch.indexer.Indexer.search").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def search_result(self, records):
+        return {"hits": {"hits": [{"_id": r["id"]} for r in records]}}
+
+    def test_storage_is_wrapped(self):
+        assert isinstance(self.app.app.registry.storage, SearchStorage)
+
+    def test_filtered_records_are_listed_in_index_order(self):
+        self.search.return_value = self.search_result([self.records[2], self.records[0]])
+        querystring = "not_age=21&_sort=-age&_limit=10"
+        resp = self.app.get("/buckets/bid/collections/cid/records?" + querystring,
+                            headers=self.headers)
+        assert resp.json["data"] == [self.records[2], self.records[0]]
+        body = self.search.call_args[1]["body"]
+        assert body["query"] == {"bool": {"must_not": [{"term": {"age": 21}}]}}
+        assert body["size"] == 11  # Limit is incremented to detect next page.
+
+    def test_storage_is_used_if_index_is_not_up_to_date(self):
+        registry = self.app.app.registry
+        registry.indexer.mark_dirty(registry.cache, "bid", "cid")
+        resp = self.app.get("/buckets/bid/collections/cid/records?min_age=20",
+                            headers=self.headers)
+        assert len(resp.json["data"]) == 2
+        assert not self.search.called
+
+    def test_index_is_used_after_deletions(self):
+        self.app.delete("/buckets/bid/collections/cid/records/" + self.records[0]["id"],
+                        headers=self.headers)
+        self.search.return_value = self.search_result([self.records[1]])
+        resp = self.app.get("/buckets/bid/collections/cid/records?min_age=20",
+                            headers=self.headers)
+        assert resp.json["data"] == [self.records[1]]
+        assert self.search.called
+
+    def test_index_is_used_after_unchanged_records_are_skipped(self):
+        record = self.records[0]
+        with mock.patch.object(self.app.app.registry.indexer, "skip_unchanged", True):
+            self.app.put_json("/buckets/bid/collections/cid/records/" + record["id"],
+                              {"data": {"age": record["age"]}}, headers=self.headers)
+        self.search.return_value = self.search_result([self.records[1]])
+        self.app.get("/buckets/bid/collections/cid/records?min_age=20", headers=self.headers)
+        assert self.search.called
+
+    def test_storage_is_used_if_index_fails(self):
+        self.search.side_effect = elasticsearch.ConnectionError("N/A", "down", None)
+        resp = self.app.get("/buckets/bid/collections/cid/records?min_age=20",
+                            headers=self.headers)
+        assert len(resp.json["data"]) == 2
+
+    def test_storage_is_used_for_unsupported_or_simple_queries(self):
+        for querystring in ("", "_sort=last_modified", "title=abc", "_since=0&min_age=2"):
+            self.app.get("/buckets/bid/collections/cid/records?" + querystring,
+                         headers=self.headers)
+        assert not self.search.called
+
+    def test_storage_is_used_outside_records_listing(self):
+        storage = self.app.app.registry.storage
+        records = storage.list_all(resource_name="record",
+                                   parent_id="/buckets/bid/collections/cid",
+                                   filters=[Filter("age", 20, COMPARISON.MIN)],
+                                   limit=10)
+        assert len(records) == 2
+        assert not self.search.called
+
+
+class IndicesDeletion(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = Indexer(hosts=[])
+        indices = self.indexer.client.indices
+        patch = mock.patch.object(indices, "get_alias", return_value={"kinto-bid-a": {},
+                                                                      "kinto-bid-b": {}})
+        self.get_alias = patch.start()
+        self.addCleanup(patch.stop)
+        patch = mock.patch.object(indices, "delete")
+        self.delete = patch.start()
+        self.addCleanup(patch.stop)
+        scripts = {"kinto-bid-a.t": {}, "kinto-bid-x-a.t": {}, "kinto-other-a.t": {}}
+        patch = mock.patch.object(self.indexer.client.cluster, "state",
+                                  return_value={"metadata": {"stored_scripts": scripts}})
+        patch.start()
+        self.addCleanup(patch.stop)
+        patch = mock.patch.object(self.indexer.client, "delete_script")
+        self.delete_script = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_collections_indices_are_deleted_in_one_call(self):
+        self.indexer.delete_indices(collections=[("bid", "a"), ("bid", "b")])
+        self.delete.assert_called_once_with(index="kinto-bid-a,kinto-bid-b",
+                                            ignore_unavailable=True)
+        assert not self.get_alias.called
+
+    def test_buckets_indices_are_resolved_before_deletion(self):
+        self.indexer.delete_indices(bucket_ids=["bid", "bid2"])
+        self.get_alias.assert_called_once_with(index="kinto-bid-*,kinto-bid2-*")
+        self.delete.assert_called_once_with(index="kinto-bid-a,kinto-bid-b",
+                                            ignore_unavailable=True)
+
+    def test_indices_of_other_buckets_are_kept(self):
+        self.get_alias.return_value = {"kinto-bid-a": {}, "kinto-bid-x-a": {}}
+        self.indexer.delete_indices(bucket_ids=["bid"], keep=["kinto-bid-x-a"])
+        self.delete.assert_called_once_with(index="kinto-bid-a", ignore_unavailable=True)
+
+    def test_templates_of_buckets_are_deleted(self):
+        self.indexer.delete_indices(bucket_ids=["bid"], keep=["kinto-bid-x-a"])
+        self.delete_script.assert_called_once_with(id="kinto-bid-a.t", ignore=404)
+
+    def test_templates_are_left_to_listener_when_collections_are_deleted(self):
+        self.indexer.delete_indices(collections=[("bid", "a")])
+        assert not self.delete_script.called
+
+    def test_nothing_is_deleted_if_no_index_matches(self):
+        self.get_alias.return_value = {}
+        self.indexer.delete_index("bid")
+        assert not self.delete.called
+
+    def test_long_lists_of_indices_are_split(self):
+        collections = [("bid", "c%04d" % i) for i in range(500)]
+        self.indexer.delete_indices(collections=collections)
+        assert self.delete.call_count > 1
+        deleted = []
+        for call in self.delete.call_args_list:
+            assert len(call[1]["index"]) <= 3000
+            deleted.extend(call[1]["index"].split(","))
+        assert deleted == [self.indexer.indexname(*c) for c in collections]
+
+    def test_flush_resolves_indices(self):
+        self.indexer.flush()
+        self.get_alias.assert_called_once_with(index="kinto-*")
+        self.delete.assert_called_once_with(index="kinto-bid-a,kinto-bid-b",
+                                            ignore_unavailable=True)
+
+    def test_flush_deletes_templates(self):
+        self.indexer.flush()
+        assert self.delete_script.call_count == 3
+
 
 class ParentDeletion(BaseWebTest, unittest.TestCase):
 
@@ -138,6 +1173,57 @@ class ParentDeletion(BaseWebTest, unittest.TestCase):
         self.app.delete("/buckets/bid", headers=self.headers)
         assert not self.index_exists("bid", "cid")
 
+    def test_indices_of_buckets_with_same_prefix_are_kept(self):
+        self.app.put("/buckets/bid-x", headers=self.headers)
+        self.app.put("/buckets/bid-x/collections/cid", headers=self.headers)
+        self.app.put("/buckets/bid2", headers=self.headers)
+        self.app.put("/buckets/bid2/collections/cid", headers=self.headers)
+        self.app.delete("/buckets/bid", headers=self.headers)
+        assert not self.index_exists("bid", "cid")
+        assert self.index_exists("bid-x", "cid")
+        assert self.index_exists("bid2", "cid")
+
+    def test_indices_of_buckets_with_same_prefix_are_kept_beyond_fetch_limit(self):
+        for bucket_id in ("bid-a", "bid-b", "bid-c"):
+            self.app.put("/buckets/%s" % bucket_id, headers=self.headers)
+            self.app.put("/buckets/%s/collections/cid" % bucket_id, headers=self.headers)
+        storage = self.app.app.registry.storage
+        list_all = storage.list_all
+
+        def capped(*args, **kwargs):
+            return list_all(*args, **kwargs)[:1]
+
+        with mock.patch.object(storage, "list_all", side_effect=capped):
+            self.app.delete("/buckets/bid", headers=self.headers)
+        assert not self.index_exists("bid", "cid")
+        for bucket_id in ("bid-a", "bid-b", "bid-c"):
+            assert self.index_exists(bucket_id, "cid")
+
+    def test_indices_are_kept_if_buckets_with_same_prefix_cannot_be_listed(self):
+        storage = self.app.app.registry.storage
+        with mock.patch.object(storage, "list_all", side_effect=BackendError):
+            with mock.patch("kinto_elasticsearch.listener.logger") as logger:
+                self.app.delete("/buckets/bid", headers=self.headers)
+        assert "their indices are kept" in logger.exception.call_args[0][0]
+        assert self.index_exists("bid", "cid")
+
+    def test_templates_are_deleted_when_bucket_is_deleted(self):
+        templates = {"latest": {"sort": "last_modified"}}
+        self.app.patch_json("/buckets/bid/collections/cid",
+                            {"data": {"index:templates": templates}}, headers=self.headers)
+        self.app.delete("/buckets/bid", headers=self.headers)
+        client = self.app.app.registry.indexer.client
+        assert client.get_script(id="kinto-bid-cid.latest", ignore=404)["found"] is False
+
+    def test_indices_are_deleted_in_one_call_when_bucket_is_deleted(self):
+        self.app.put("/buckets/bid/collections/cid2", headers=self.headers)
+        indices = self.app.app.registry.indexer.client.indices
+        with mock.patch.object(indices, "delete", wraps=indices.delete) as delete:
+            self.app.delete("/buckets/bid", headers=self.headers)
+            assert delete.call_count == 1
+        assert not self.index_exists("bid", "cid")
+        assert not self.index_exists("bid", "cid2")
+
 
 class SearchView(BaseWebTest, unittest.TestCase):
     def setUp(self):
@@ -152,6 +1238,24 @@ class SearchView(BaseWebTest, unittest.TestCase):
             result = resp.json
             assert result == {}
 
+    def test_search_is_unavailable_while_circuit_breaker_is_open(self):
+        with mock.patch("kinto_elasticsearch.indexer.Indexer.search",
+                        side_effect=CircuitOpenError(12)):
+            resp = self.app.post("/buckets/bid/collections/cid/search",
+                                 headers=self.headers, status=503)
+        assert resp.headers["Retry-After"] == "12"
+        assert resp.json["errno"] == 201
+
+    def test_search_failures_are_counted(self):
+        statsd_client = self.app.app.registry.statsd._client
+        with mock.patch("kinto_elasticsearch.indexer.Indexer.search",
+                        side_effect=elasticsearch.ElasticsearchException):
+            with mock.patch.object(statsd_client, 'incr') as incr:
+                self.app.post("/buckets/bid/collections/cid/search",
+                              headers=self.headers)
+        counters = set(c[0][0] for c in incr.call_args_list)
+        assert 'plugins.elasticsearch.search.failures' in counters
+
     def test_invalid_search_query(self):
         body = {"whatever": {"wrong": "bad"}}
         resp = self.app.post_json("/buckets/bid/collections/cid/search",
@@ -194,6 +1298,364 @@ class SearchView(BaseWebTest, unittest.TestCase):
         assert len(result["hits"]["hits"]) == 2
 
 
+class FacetsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = Indexer(hosts=[])
+        self.cache = Cache(cache_prefix="", cache_max_size_bytes=float("inf"))
+        self.storage = mock.MagicMock()
+        self.storage.resource_timestamp.return_value = 42
+        self.metadata = {"last_modified": 1, "index:facets": {"tags": {"terms": {"field": "t"}}}}
+        self.indexer.mark_indexed(self.cache, "bid", "cid", 42)
+        self.search = mock.patch.object(self.indexer, "search", return_value={
+            "aggregations": {"tags": {"buckets": []}},
+        }).start()
+        self.refresh = mock.patch.object(self.indexer.client.indices, "refresh").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def facets(self):
+        return self.indexer.facets(self.storage, self.cache, "bid", "cid", self.metadata)
+
+    def test_results_are_cached_until_records_change(self):
+        assert self.facets() == {"tags": {"buckets": []}}
+        self.facets()
+        assert self.search.call_count == 1
+        self.indexer.invalidate_facets(self.cache, "bid", "cid")
+        self.facets()
+        assert self.search.call_count == 2
+
+    def test_results_are_recomputed_if_collection_changes(self):
+        self.facets()
+        self.metadata = dict(self.metadata, last_modified=2)
+        self.facets()
+        assert self.search.call_count == 2
+
+    def test_results_are_not_cached_if_index_is_not_up_to_date(self):
+        self.storage.resource_timestamp.return_value = 43
+        self.facets()
+        self.facets()
+        assert self.search.call_count == 2
+
+    def test_index_is_refreshed_before_results_are_cached(self):
+        self.facets()
+        self.refresh.assert_called_with(index="kinto-bid-cid")
+
+    def test_index_is_not_refreshed_if_results_are_not_cached(self):
+        self.storage.resource_timestamp.return_value = 43
+        self.facets()
+        assert not self.refresh.called
+
+    def test_index_is_not_refreshed_if_bulk_requests_wait_for_it(self):
+        self.indexer.records_listing = True
+        self.facets()
+        assert not self.refresh.called
+
+    def test_results_are_not_cached_if_collection_is_dirty(self):
+        self.indexer.mark_dirty(self.cache, "bid", "cid")
+        self.facets()
+        self.facets()
+        assert self.search.call_count == 2
+
+    def test_definitions_are_sent_as_aggregations(self):
+        self.facets()
+        aggs = self.search.call_args[1]["body"]["aggs"]
+        assert aggs == {"tags": {"terms": {"field": "t"}}}
+
+
+class FacetsView(BaseWebTest, unittest.TestCase):
+
+    def setUp(self):
+        facets = {"tags": {"terms": {"field": "tags"}}}
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put_json("/buckets/bid/collections/cid",
+                          {"data": {"index:facets": facets}},
+                          headers=self.headers)
+        self.app.put("/buckets/bid/collections/nofacets", headers=self.headers)
+
+    def test_facets_are_returned(self):
+        with mock.patch("kinto_elasticsearch.indexer.Indexer.facets",
+                        return_value={"tags": {"buckets": []}}):
+            resp = self.app.get("/buckets/bid/collections/cid/facets", headers=self.headers)
+        assert resp.json == {"tags": {"buckets": []}}
+
+    def test_facets_are_empty_if_not_defined(self):
+        resp = self.app.get("/buckets/bid/collections/nofacets/facets", headers=self.headers)
+        assert resp.json == {}
+
+    def test_facets_of_unknown_collection_returns_404(self):
+        self.app.get("/buckets/bid/collections/unknown/facets", headers=self.headers,
+                     status=404)
+
+    def test_facets_require_read_permission(self):
+        self.app.get("/buckets/bid/collections/cid/facets",
+                     headers=get_user_headers("tartan:pion"), status=403)
+
+    def test_cached_facets_are_invalidated_when_records_change(self):
+        indexer = self.app.app.registry.indexer
+        with mock.patch.object(indexer, "invalidate_facets") as invalidate:
+            self.app.post_json("/buckets/bid/collections/cid/records",
+                               {"data": {"tags": ["a"]}}, headers=self.headers)
+        invalidate.assert_called_with(self.app.app.registry.cache, "bid", "cid")
+
+    def test_invalid_definitions_return_400(self):
+        error = elasticsearch.RequestError(400, "parsing_exception",
+                                           {"error": {"reason": "Unknown aggregation"}})
+        with mock.patch("kinto_elasticsearch.indexer.Indexer.search", side_effect=error):
+            self.app.get("/buckets/bid/collections/cid/facets", headers=self.headers,
+                         status=400)
+
+    def test_facets_are_unavailable_while_circuit_breaker_is_open(self):
+        with mock.patch("kinto_elasticsearch.indexer.Indexer.search",
+                        side_effect=CircuitOpenError(3)):
+            resp = self.app.get("/buckets/bid/collections/cid/facets", headers=self.headers,
+                                status=503)
+        assert resp.headers["Retry-After"] == "3"
+
+    def test_facets_are_empty_if_indexer_fails(self):
+        with mock.patch("kinto_elasticsearch.indexer.Indexer.search",
+                        side_effect=elasticsearch.ElasticsearchException):
+            resp = self.app.get("/buckets/bid/collections/cid/facets", headers=self.headers)
+        assert resp.json == {}
+
+
+class SearchTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = Indexer(hosts=[])
+        self.client = mock.patch.object(self.indexer, "_client", mock.MagicMock()).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_changed_templates_are_stored_as_mustache_scripts(self):
+        templates = {"by_author": {"query": {"term": {"author": "{{author}}"}}},
+                     "latest": "{\"sort\": \"last_modified\"}"}
+        self.indexer.update_templates("bid", "cid", templates,
+                                      previous={"latest": templates["latest"]})
+        assert self.client.put_script.call_count == 1
+        kwargs = self.client.put_script.call_args[1]
+        assert kwargs["id"] == "kinto-bid-cid.by_author"
+        assert kwargs["body"] == {"script": {
+            "lang": "mustache",
+            "source": '{"query": {"term": {"author": "{{author}}"}}}'}}
+
+    def test_removed_templates_are_deleted(self):
+        self.indexer.update_templates("bid", "cid", {}, previous={"latest": "{}"})
+        self.client.delete_script.assert_called_with(id="kinto-bid-cid.latest", ignore=404)
+
+    def test_templates_are_run_with_params(self):
+        self.client.search_template.return_value = {"took": 1, "hits": {}}
+        self.indexer.search_template("bid", "cid", "by_author", {"author": "Mat"})
+        kwargs = self.client.search_template.call_args[1]
+        assert kwargs["index"] == "kinto-bid-cid"
+        assert kwargs["body"] == {"id": "kinto-bid-cid.by_author", "params": {"author": "Mat"}}
+
+
+class SearchTemplateView(BaseWebTest, unittest.TestCase):
+
+    templates = {"by_author": {"query": {"term": {"author": "{{author}}"}}}}
+
+    def setUp(self):
+        self.indexer = self.app.app.registry.indexer
+        self.app.put("/buckets/bid", headers=self.headers)
+        with mock.patch.object(self.indexer, "update_templates") as update_templates:
+            self.app.put_json("/buckets/bid/collections/cid",
+                              {"data": {"index:templates": self.templates}},
+                              headers=self.headers)
+        self.stored = update_templates
+        self.url = "/buckets/bid/collections/cid/search/by_author"
+
+    def test_templates_are_stored_when_collection_is_created(self):
+        self.stored.assert_called_with("bid", "cid", self.templates)
+
+    def test_templates_are_stored_when_collection_is_updated(self):
+        templates = {"latest": {"sort": "last_modified"}}
+        with mock.patch.object(self.indexer, "update_templates") as update_templates:
+            self.app.patch_json("/buckets/bid/collections/cid",
+                                {"data": {"index:templates": templates}},
+                                headers=self.headers)
+            self.app.patch_json("/buckets/bid/collections/cid",
+                                {"data": {"title": "Unrelated"}},
+                                headers=self.headers)
+        update_templates.assert_called_once_with("bid", "cid", templates,
+                                                 previous=self.templates)
+
+    def test_templates_are_deleted_with_collection(self):
+        with mock.patch.object(self.indexer, "update_templates") as update_templates:
+            self.app.delete("/buckets/bid/collections/cid", headers=self.headers)
+        update_templates.assert_called_with("bid", "cid", {}, previous=self.templates)
+
+    def test_querystring_is_passed_as_params(self):
+        with mock.patch.object(self.indexer, "search_template",
+                               return_value={"hits": {}}) as search_template:
+            resp = self.app.get(self.url + "?author=Mat", headers=self.headers)
+        assert resp.json == {"hits": {}}
+        search_template.assert_called_with("bid", "cid", "by_author", {"author": "Mat"})
+
+    def test_body_is_passed_as_params(self):
+        with mock.patch.object(self.indexer, "search_template",
+                               return_value={"hits": {}}) as search_template:
+            self.app.post_json(self.url, {"author": "Mat"}, headers=self.headers)
+        search_template.assert_called_with("bid", "cid", "by_author", {"author": "Mat"})
+
+    def test_params_must_be_an_object(self):
+        self.app.post_json(self.url, ["Mat"], headers=self.headers, status=400)
+        self.app.post(self.url, "{", headers=self.headers, status=400)
+
+    def test_unknown_templates_return_404(self):
+        self.app.get("/buckets/bid/collections/cid/search/unknown", headers=self.headers,
+                     status=404)
+        self.app.get("/buckets/bid/collections/unknown/search/by_author",
+                     headers=self.headers, status=404)
+
+    def test_templates_require_read_permission(self):
+        self.app.get(self.url, headers=get_user_headers("tartan:pion"), status=403)
+
+    def test_missing_templates_are_stored_again(self):
+        with mock.patch.object(self.indexer, "search_template",
+                               side_effect=[elasticsearch.NotFoundError, {}]):
+            with mock.patch.object(self.indexer, "update_templates") as update_templates:
+                with mock.patch.object(self.indexer, "create_index"):
+                    self.app.get(self.url, headers=self.headers)
+        update_templates.assert_called_with("bid", "cid", self.templates)
+
+    def test_invalid_params_return_400(self):
+        error = elasticsearch.RequestError(400, "parsing_exception",
+                                           {"error": {"reason": "Unknown query"}})
+        with mock.patch.object(self.indexer, "search_template", side_effect=error):
+            resp = self.app.get(self.url, headers=self.headers, status=400)
+        assert resp.json["details"] == {"reason": "Unknown query"}
+
+    def test_templates_are_unavailable_while_circuit_breaker_is_open(self):
+        with mock.patch.object(self.indexer, "search_template",
+                               side_effect=CircuitOpenError(3)):
+            resp = self.app.get(self.url, headers=self.headers, status=503)
+        assert resp.headers["Retry-After"] == "3"
+
+    def test_results_are_empty_if_indexer_fails(self):
+        with mock.patch.object(self.indexer, "search_template",
+                               side_effect=elasticsearch.ElasticsearchException):
+            resp = self.app.get(self.url, headers=self.headers)
+        assert resp.json == {}
+
+
+class Suggestions(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = Indexer(hosts=[])
+        self.cache = Cache(cache_prefix="", cache_max_size_bytes=float("inf"))
+        self.search = mock.patch.object(self.indexer, "search", return_value={
+            "suggest": {"title": [{"text": "ab", "options": []}]},
+        }).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def suggest(self, prefix="ab"):
+        return self.indexer.suggest(self.cache, "bid", "cid", ["title"], prefix, size=3)
+
+    def test_completion_suggesters_are_requested(self):
+        assert self.suggest() == {"title": [{"text": "ab", "options": []}]}
+        body = self.search.call_args[1]["body"]
+        assert body["size"] == 0
+        assert body["suggest"] == {"title": {"prefix": "ab", "completion": {
+            "field": "title", "size": 3, "skip_duplicates": True}}}
+
+    def test_results_are_cached_by_prefix(self):
+        self.suggest()
+        self.suggest()
+        assert self.search.call_count == 1
+        self.suggest(prefix="abc")
+        assert self.search.call_count == 2
+
+    def test_completion_fields_are_read_from_schema(self):
+        schema = {"properties": {"title": {"type": "completion"},
+                                 "author": {"properties": {"name": {"type": "completion"},
+                                                           "age": {"type": "long"}}}}}
+        assert completion_fields(schema) == ["title", "author.name"]
+        assert completion_fields(None) == []
+
+    def test_throttle_enforces_an_interval_per_user(self):
+        throttle = Throttle(min_interval=60)
+        assert throttle.wait("alice") == 0
+        assert 59 < throttle.wait("alice") <= 60
+        assert throttle.wait("bob") == 0
+
+    def test_throttle_forgets_oldest_users(self):
+        throttle = Throttle(min_interval=60, max_users=1)
+        throttle.wait("alice")
+        throttle.wait("bob")
+        assert throttle.wait("alice") == 0
+
+
+class SuggestView(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["kinto.elasticsearch.suggest_min_interval"] = "0"
+        return settings
+
+    def setUp(self):
+        schema = {"properties": {"title": {"type": "completion"},
+                                 "tags": {"type": "completion"}}}
+        self.indexer = self.app.app.registry.indexer
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put_json("/buckets/bid/collections/cid",
+                          {"data": {"index:schema": schema}},
+                          headers=self.headers)
+        self.app.put("/buckets/bid/collections/nocompletion", headers=self.headers)
+        self.url = "/buckets/bid/collections/cid/suggest"
+        self.addCleanup(setattr, self.indexer, "suggest_throttle", None)
+
+    def test_suggestions_of_every_completion_field_are_returned(self):
+        with mock.patch.object(self.indexer, "suggest",
+                               return_value={"title": []}) as suggest:
+            resp = self.app.get(self.url + "?q=ab", headers=self.headers)
+        assert resp.json == {"title": []}
+        assert sorted(suggest.call_args[0][3]) == ["tags", "title"]
+        assert suggest.call_args[0][4] == "ab"
+        assert suggest.call_args[1]["size"] == 5
+
+    def test_suggestions_can_be_limited_to_one_field(self):
+        with mock.patch.object(self.indexer, "suggest", return_value={}) as suggest:
+            self.app.get(self.url + "?q=ab&field=tags&size=2", headers=self.headers)
+        assert suggest.call_args[0][3] == ["tags"]
+        assert suggest.call_args[1]["size"] == 2
+
+    def test_invalid_parameters_return_400(self):
+        self.app.get(self.url, headers=self.headers, status=400)
+        self.app.get(self.url + "?q=ab&field=unknown", headers=self.headers, status=400)
+        self.app.get(self.url + "?q=ab&size=0", headers=self.headers, status=400)
+        self.app.get(self.url + "?q=ab&size=abc", headers=self.headers, status=400)
+
+    def test_suggestions_are_empty_without_completion_fields(self):
+        resp = self.app.get("/buckets/bid/collections/nocompletion/suggest?q=ab",
+                            headers=self.headers)
+        assert resp.json == {}
+
+    def test_suggestions_of_unknown_collection_returns_404(self):
+        self.app.get("/buckets/bid/collections/unknown/suggest?q=ab", headers=self.headers,
+                     status=404)
+
+    def test_suggestions_require_read_permission(self):
+        self.app.get(self.url + "?q=ab", headers=get_user_headers("tartan:pion"), status=403)
+
+    def test_requests_are_throttled_per_user(self):
+        self.indexer.suggest_throttle = Throttle(min_interval=60)
+        with mock.patch.object(self.indexer, "suggest", return_value={}):
+            self.app.get(self.url + "?q=a", headers=self.headers)
+            resp = self.app.get(self.url + "?q=ab", headers=self.headers, status=429)
+        assert resp.headers["Retry-After"] == "60"
+
+    def test_suggestions_are_unavailable_while_circuit_breaker_is_open(self):
+        with mock.patch.object(self.indexer, "search", side_effect=CircuitOpenError(3)):
+            resp = self.app.get(self.url + "?q=ab", headers=self.headers, status=503)
+        assert resp.headers["Retry-After"] == "3"
+
+    def test_suggestions_are_empty_if_indexer_fails(self):
+        with mock.patch.object(self.indexer, "search",
+                               side_effect=elasticsearch.ElasticsearchException):
+            resp = self.app.get(self.url + "?q=ab", headers=self.headers)
+        assert resp.json == {}
+
+
 class LimitedResults(BaseWebTest, unittest.TestCase):
     def get_app(self, settings):
         app = self.make_app(settings=settings)
@@ -253,6 +1715,33 @@ class LimitedResults(BaseWebTest, unittest.TestCase):
         result = resp.json
         assert len(result["hits"]["hits"]) == 3
 
+    def test_the_number_of_template_results_is_limited(self):
+        app = self.get_app({"paginate_by": 2})
+        templates = {"all": {"size": "{{size}}{{^size}}10{{/size}}"}}
+        app.patch_json("/buckets/bid/collections/cid", {"data": {"index:templates": templates}},
+                       headers=self.headers)
+        hits = {"hits": {"hits": [{"_id": str(i)} for i in range(5)]}}
+        with mock.patch("kinto_elasticsearch.indexer.Indexer.search_template",
+                        return_value=hits):
+            resp = app.get("/buckets/bid/collections/cid/search/all", headers=self.headers)
+        assert len(resp.json["hits"]["hits"]) == 2
+
+    def test_suggestions_size_larger_than_setting_is_rejected(self):
+        app = self.get_app({"paginate_by": 2})
+        schema = {"properties": {"title": {"type": "completion"}}}
+        app.patch_json("/buckets/bid/collections/cid", {"data": {"index:schema": schema}},
+                       headers=self.headers)
+        app.get("/buckets/bid/collections/cid/suggest?q=ab&size=3", headers=self.headers,
+                status=400)
+
+    def test_template_size_larger_than_setting_is_rejected(self):
+        app = self.get_app({"paginate_by": 2})
+        templates = {"all": {"size": "{{size}}"}}
+        app.patch_json("/buckets/bid/collections/cid", {"data": {"index:templates": templates}},
+                       headers=self.headers)
+        app.get("/buckets/bid/collections/cid/search/all?size=3", headers=self.headers,
+                status=400)
+
 
 class PermissionsCheck(BaseWebTest, unittest.TestCase):
     def test_search_is_allowed_if_write_on_bucket(self):
@@ -412,3 +1901,30 @@ class SchemaSupport(BaseWebTest, unittest.TestCase):
                         side_effect=e):
             self.app.post_json("/buckets/bid/collections/cid/search",
                                headers=self.headers, status=400)
+
+
+class BackgroundIndexing(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["kinto.elasticsearch.synchronous_indexing"] = "false"
+        return settings
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+
+    def test_records_are_not_indexed_during_requests(self):
+        indexer = self.app.app.registry.indexer
+        with mock.patch.object(indexer, "bulk") as bulk:
+            self.app.post_json("/buckets/bid/collections/cid/records",
+                               {"data": {"hello": "world"}}, headers=self.headers)
+        assert not bulk.called
+
+    def test_cached_facets_are_invalidated_when_records_change(self):
+        indexer = self.app.app.registry.indexer
+        with mock.patch.object(indexer, "invalidate_facets") as invalidate_facets:
+            self.app.post_json("/buckets/bid/collections/cid/records",
+                               {"data": {"hello": "world"}}, headers=self.headers)
+        invalidate_facets.assert_called_with(mock.ANY, "bid", "cid")